@@ -0,0 +1,76 @@
+"""
+Seconds/image of SDImageGenerator for every CPU inference option.
+
+Every profile starts from the plain float32 pipeline and switches on the listed SD_CPU_* settings, the `all`
+profile combines them. Each profile loads its own pipeline, renders one untimed image and then `--images` timed
+ones:
+
+    python benchmark_sd.py --images 3 --steps 20 --threads 16
+    python benchmark_sd.py --profiles baseline,bf16,all
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from config import settings
+from image_generator import SDImageGenerator
+
+
+PROFILES = {
+    "baseline": {},
+    "threads": {"SD_CPU_THREADS": None},
+    "bf16": {"SD_CPU_BF16": True},
+    "channels_last": {"SD_CPU_CHANNELS_LAST": True},
+    "attention_slicing": {"SD_CPU_ATTENTION_SLICING": True},
+    "compile": {"SD_CPU_COMPILE": True},
+    "quantize_text_encoder": {"SD_CPU_QUANTIZE_TEXT_ENCODER": True},
+    "all": {"SD_CPU_THREADS": None, "SD_CPU_BF16": True, "SD_CPU_CHANNELS_LAST": True,
+            "SD_CPU_ATTENTION_SLICING": True, "SD_CPU_COMPILE": True, "SD_CPU_QUANTIZE_TEXT_ENCODER": True},
+}
+
+PROMPT = ("A majestic starship soars through the cosmos, its sleek lines and glowing engines cutting through "
+          "the inky blackness of space. In the distance, a swirling nebula glows like a celestial jellyfish")
+
+
+def run_profile(name: str, overrides: dict, args) -> float:
+    defaults = {key: getattr(settings, key) for key in PROFILES["all"]}
+    threads = torch.get_num_threads()
+    try:
+        for key, value in overrides.items():
+            setattr(settings, key, args.threads if value is None else value)
+        generator = SDImageGenerator()
+        out_dir = tempfile.mkdtemp(prefix=f"benchmark-sd-{name}-")
+        generator.generate(PROMPT, os.path.join(out_dir, "warm-up.jpg"))
+        start = time.perf_counter()
+        for i in range(args.images):
+            generator.generate(PROMPT, os.path.join(out_dir, f"{i}.jpg"))
+        return (time.perf_counter() - start) / args.images
+    finally:
+        for key, value in defaults.items():
+            setattr(settings, key, value)
+        torch.set_num_threads(threads)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SDImageGenerator CPU benchmark')
+    parser.add_argument('--images', type=int, default=3, help='Timed images per profile')
+    parser.add_argument('--steps', type=int, default=20, help='Inference steps per image')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='Torch threads for the threads profile')
+    parser.add_argument('--profiles', type=str, default=",".join(PROFILES), help='Comma separated profile names')
+    args = parser.parse_args()
+
+    settings.USE_GPU = False
+    settings.SD_ITERATIONS = args.steps
+    results = {}
+    for name in args.profiles.split(","):
+        results[name] = run_profile(name, PROFILES[name], args)
+        print(f"{name:>24}: {results[name]:8.2f} secs/image")
+
+    baseline = results.get("baseline")
+    if baseline:
+        print()
+        for name, secs in results.items():
+            print(f"{name:>24}: {baseline / secs:5.2f}x")
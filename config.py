@@ -6,6 +6,21 @@ import random
 class Settings(BaseSettings):
     BASE_IMG_PATH: str = "images"
     DB_NAME: str = "tickets.sqlite"
+    DB_READ_CONNECTIONS: int = 2
+    # WAL needs shared memory, so it only works for processes on one host; nodes on several hosts sharing the
+    # DB file over a network filesystem must use DELETE and a filesystem with working POSIX locks
+    DB_JOURNAL_MODE: str = "WAL"
+    DB_SYNCHRONOUS: str = "NORMAL"
+    DB_CACHE_SIZE_KB: int = 16384
+    DB_BUSY_TIMEOUT_MS: int = 5000
+    DB_STATEMENT_CACHE_SIZE: int = 256
+
+    WEB_PORT: int = 8080
+    # the dashboard serves statistics snapshots refreshed every STATS_INTERVAL secs and after every status check,
+    # its "refresh now" also polls the pending tickets and runs at most once per STATS_REFRESH_MIN_INTERVAL secs
+    STATS_INTERVAL: int = 30
+    STATS_REFRESH_MIN_INTERVAL: int = 60
+    STATS_KEEPALIVE_INTERVAL: int = 15
 
     ENABLE_CREATE_TICKETS: bool = True
     ENABLE_CHECK_STATUSES: bool = True
@@ -13,6 +28,52 @@ class Settings(BaseSettings):
     CREATE_TICKET_INTERVAL: int = 300
     CHECK_INTERVAL: int = 600
     GENERATE_IMAGE_INTERVAL: int = 10
+    # unused image backlog at which generation pauses / runs without GENERATE_IMAGE_INTERVAL, high 0 - off
+    GENERATE_LOW_WATERMARK: int = 20
+    GENERATE_HIGH_WATERMARK: int = 100
+    # secs between backlog checks while generation is paused, at least 1
+    BACKLOG_POLL_INTERVAL: int = 10
+    # unload the models once generation has been disabled and they were not used for this many secs, 0 - never
+    MODEL_UNLOAD_AFTER: int = 600
+    # image generation pipeline: workers per stage and bounded queues between them,
+    # more than one prompt or render worker needs generators that are safe to call from several threads
+    PROMPT_WORKERS: int = 1
+    RENDER_WORKERS: int = 1
+    STORE_WORKERS: int = 1
+    PROMPT_QUEUE_SIZE: int = 4
+    IMAGE_QUEUE_SIZE: int = 16
+    CREATE_TICKET_WORKERS: int = 1
+    CLAIM_LEASE_SECONDS: int = 900
+    CASCADE_BATCH_SIZE: int = 1
+    SENSE_BATCH_SIZE: int = 1
+    CASCADE_TARGET_PER_HOUR: float = 4.0
+    SENSE_TARGET_PER_HOUR: float = 4.0
+    NFT_TARGET_PER_HOUR: float = 4.0
+    CASCADE_MAX_IN_FLIGHT: int = 20
+    SENSE_MAX_IN_FLIGHT: int = 20
+    NFT_MAX_IN_FLIGHT: int = 20
+    SCHEDULER_MAX_BURST: float = 3.0
+    # secs a create_ticket worker waits after a submission that registered nothing
+    CREATE_TICKET_RETRY_DELAY: int = 10
+    STATUS_CHECK_CONCURRENCY: int = 32
+    STATUS_CHECK_CONCURRENCY_PER_TYPE: int = 16
+    STATUS_UPDATE_BATCH_SIZE: int = 200
+    POLL_MIN_INTERVAL: int = 60
+    POLL_MAX_INTERVAL: int = 21600
+    POLL_BACKOFF_FACTOR: float = 2.0
+
+    # requests per second, per endpoint
+    GATEWAY_RATE_LIMIT_PROCESS: float = 1.0
+    GATEWAY_RATE_LIMIT_RESULT: float = 20.0
+    GATEWAY_RATE_LIMIT_DEFAULT: float = 5.0
+    GATEWAY_RATE_BURST: int = 10
+    GATEWAY_MAX_RETRIES: int = 3
+    GATEWAY_BACKOFF_BASE: float = 1.0
+    GATEWAY_BACKOFF_MAX: float = 30.0
+    GATEWAY_BREAKER_ERROR_RATE: float = 0.5
+    GATEWAY_BREAKER_MIN_CALLS: int = 10
+    GATEWAY_BREAKER_WINDOW: float = 60.0
+    GATEWAY_BREAKER_COOLDOWN: float = 120.0
 
     ENABLE_CASCADE: bool = False
     ENABLE_SENSE: bool = False
@@ -24,10 +85,40 @@ class Settings(BaseSettings):
     PROMPT_CHAT_FORMAT: str
     IMAGE_MODEL_ID: str
     GRAMMAR_PATH: str
+    BATCH_GRAMMAR_PATH: str = "grammar-img-batch.gbnf"
+    PROMPT_CONTEXT_SIZE: int = 2048
+    # descriptions asked for in one completion, 1 - one completion per image
+    PROMPT_BATCH_SIZE: int = 1
+    # token budget per description and char budget per field of a streamed completion, 0 - no limit
+    PROMPT_MAX_TOKENS: int = 512
+    PROMPT_MAX_FIELD_CHARS: int = 1500
+    # prompts at least this similar (estimated Jaccard of word shingles) to a used one are rejected, 0 - off
+    PROMPT_DEDUP_THRESHOLD: float = 0.7
+    # images within this many differing bits of the perceptual hash of a Sense/NFT image are skipped, -1 - off
+    PHASH_MAX_DISTANCE: int = 6
+    # reuse the model state after the shared system prompt, optionally persisted for fast restarts
+    PROMPT_PREFIX_CACHE: bool = True
+    PROMPT_PREFIX_CACHE_PATH: str = ""
 
     LLAMA_SYSTEM_PROMPT: str
     LLAMA_USER_REQUEST: str
+    LLAMA_BATCH_USER_REQUEST: str = "Generate {} different image descriptions using {} genre"
     SD_ITERATIONS: int = 50
+    SD_PRESET: str = "quality"
+    SD_BATCH_SIZE: int = 1
+    SD_IMAGES_PER_PROMPT: int = 1
+    # CPU inference options, only used when USE_GPU is False
+    SD_CPU_THREADS: int = 0
+    # render in worker processes forked after the model is loaded (CPU only), 0 - render in this process;
+    # the workers start with the generator role and are not unloaded by MODEL_UNLOAD_AFTER
+    SD_WORKER_PROCESSES: int = 0
+    # torch threads per worker process, 0 - split the cores evenly between the workers
+    SD_WORKER_THREADS: int = 0
+    SD_CPU_BF16: bool = False
+    SD_CPU_CHANNELS_LAST: bool = False
+    SD_CPU_ATTENTION_SLICING: bool = False
+    SD_CPU_COMPILE: bool = False
+    SD_CPU_QUANTIZE_TEXT_ENCODER: bool = False
     IMAGE_NEGATIVE_PROMPT: str
 
     class Config:
@@ -42,6 +133,15 @@ def get_settings():
 settings = get_settings()
 
 
+# quality/throughput presets of SDImageGenerator: diffusers scheduler class, number of inference steps
+# (None - SD_ITERATIONS) and guidance scale
+SD_PRESETS = {
+    "fast": {"scheduler": "DPMSolverMultistepScheduler", "steps": 15, "guidance": 6.0},
+    "balanced": {"scheduler": "DPMSolverMultistepScheduler", "steps": 25, "guidance": 7.0},
+    "quality": {"scheduler": "EulerDiscreteScheduler", "steps": None, "guidance": 7.5},
+}
+
+
 def biased_random() -> int:
     return int(1 + (20-1) * (random.random() ** 2))
 
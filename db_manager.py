@@ -1,6 +1,13 @@
 import aiosqlite
+import asyncio
+from contextlib import asynccontextmanager
 from enum import Enum
+import logging
 import os
+import time
+
+from config import settings
+import db_migrations
 
 
 class Status(Enum):
@@ -9,9 +16,132 @@ class Status(Enum):
     FAILURE = "failure"
 
 
+# gateway result statuses that never change again, tickets in these states are not polled anymore
+TERMINAL_STATUSES = ('SUCCESS', 'FAILED', 'ERROR')
+
+# column prefixes of the image claims, Sense and NFT share the same pool of images
+CASCADE_CLAIM = 'cascade'
+SENSE_NFT_CLAIM = 'sense_nft'
+# images still available for Sense or NFT, near-duplicates of submitted images are skipped
+SENSE_NFT_AVAILABLE = "sense_id IS NULL AND nft_id IS NULL AND near_duplicate_of IS NULL"
+
+
+def schedule_next_check(status: str, check_count: int, now: float = None) -> float | None:
+    """
+    Returns when a ticket should be polled next, or None for terminal statuses.
+    Fresh tickets are polled every POLL_MIN_INTERVAL seconds and every poll that sees no change
+    multiplies the delay by POLL_BACKOFF_FACTOR, up to POLL_MAX_INTERVAL.
+    """
+    if status in TERMINAL_STATUSES:
+        return None
+    now = time.time() if now is None else now
+    delay = settings.POLL_MIN_INTERVAL * settings.POLL_BACKOFF_FACTOR ** min(check_count, 64)
+    return now + min(delay, settings.POLL_MAX_INTERVAL)
+
+
+class ConnectionPool:
+    """
+    Small pool of long-lived aiosqlite connections: one writer and N readers.
+
+    Every connection runs in WAL mode, so readers never block the writer and vice versa. The writer is guarded
+    by a lock and every `writer()` block is a single `BEGIN IMMEDIATE` transaction. Statements are kept in the
+    sqlite3 per-connection statement cache, so the fixed SQL text used by SQLiteDB is prepared only once.
+    """
+    def __init__(self, db_path, readers: int = 2):
+        self.db_path = db_path
+        self.readers_count = max(1, readers)
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+        self.reads = 0
+        self.writes = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self):
+        db = await aiosqlite.connect(self.db_path, isolation_level=None,
+                                     cached_statements=settings.DB_STATEMENT_CACHE_SIZE)
+        db.row_factory = aiosqlite.Row
+        await db.execute_fetchall(f"PRAGMA busy_timeout = {int(settings.DB_BUSY_TIMEOUT_MS)}")
+        await db.execute_fetchall(f"PRAGMA synchronous = {settings.DB_SYNCHRONOUS}")
+        await db.execute_fetchall(f"PRAGMA cache_size = -{int(settings.DB_CACHE_SIZE_KB)}")
+        await db.execute_fetchall("PRAGMA temp_store = MEMORY")
+        return db
+
+    async def open(self):
+        # a pool shared by several SQLiteDB instances is opened by all of them at once
+        async with self._open_lock:
+            if self.is_open:
+                return
+            writer = await self._connect()
+            # journal_mode is persistent in the file, setting it once on the writer is enough
+            await writer.execute_fetchall(f"PRAGMA journal_mode = {settings.DB_JOURNAL_MODE}")
+            for _ in range(self.readers_count):
+                db = await self._connect()
+                self._all_readers.append(db)
+                self._readers.put_nowait(db)
+            self._writer = writer
+
+    async def close(self):
+        if not self.is_open:
+            return
+        async with self._writer_lock:
+            for db in self._all_readers:
+                await db.close()
+            self._all_readers.clear()
+            self._readers = asyncio.Queue()
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        db = await self._readers.get()
+        self.reads += 1
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self._writer_lock:
+            self.writes += 1
+            try:
+                await self._writer.execute("BEGIN IMMEDIATE")
+                yield self._writer
+                await self._writer.execute("COMMIT")
+            except BaseException:
+                # a failed COMMIT (busy, deferred foreign key) or a cancelled BEGIN leaves the shared connection in
+                # a transaction and every later writer() would fail, roll back even if this task is being cancelled
+                rollback = asyncio.ensure_future(self._rollback())
+                try:
+                    await asyncio.shield(rollback)
+                except asyncio.CancelledError:
+                    # keep the writer lock until the connection is usable again
+                    await rollback
+                raise
+
+    async def _rollback(self):
+        try:
+            # requests run in order on the connection thread, a cancelled BEGIN may still be queued before this one
+            await self._writer.execute_fetchall("SELECT 1")
+            if self._writer.in_transaction:
+                await self._writer.execute("ROLLBACK")
+        except Exception as error:
+            logging.exception(error)
+
+
 class SQLiteDB:
-    def __init__(self, db_path, network_name):
+    def __init__(self, db_path, network_name, pool: ConnectionPool = None):
         self.db_path = db_path
+        self.network_name = network_name
+        # networks served by one process share one pool and so one writer, its owner closes it
+        self.owns_pool = pool is None
+        self.pool = pool or ConnectionPool(db_path, settings.DB_READ_CONNECTIONS)
         self.images_table_name = 'images'
         self.cascade_table_name = f'cascade_{network_name}'
         self.sense_table_name = f'sense_{network_name}'
@@ -19,188 +149,244 @@ class SQLiteDB:
         self.collection_table_name = f'collections_{network_name}'
         self.initialized = False
 
+    async def open(self):
+        await self.pool.open()
+
+    async def close(self):
+        self.initialized = False
+        if self.owns_pool:
+            await self.pool.close()
+
+    async def schema_version(self) -> int:
+        return await db_migrations.get_schema_version(self)
+
     async def _check_db(self) -> bool:
         if not os.path.exists(self.db_path):
             return False
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND "
-                                  f"name IN ('{self.images_table_name}', "
-                                  f"'{self.cascade_table_name}', "
-                                  f"'{self.sense_table_name}', "
-                                  f"'{self.nft_table_name}', "
-                                  f"'{self.collection_table_name}')") as cursor:
-                result = await cursor.fetchall()
-                return len(result) == 5
+        return await self.schema_version() == db_migrations.LATEST_VERSION
 
     async def initialize_db(self):
+        await self.open()
         db_is_ok = await self._check_db()
         if not db_is_ok:
-            async with aiosqlite.connect(self.db_path) as db:
-                # collection_type is nft or sense
-                await db.execute(f'''
-                    CREATE TABLE IF NOT EXISTS {self.collection_table_name} (
-                        id INTEGER PRIMARY KEY,
-                        collection_type TEXT,
-                        name TEXT,
-                        max_collection_entries INTEGER,
-                        collection_item_copy_count INTEGER,
-                        list_of_pastelids_of_authorized_contributors TEXT,
-                        max_permitted_open_nsfw_score REAL,
-                        minimum_similarity_score_to_first_entry_in_collection REAL,
-                        no_of_days_to_finalize_collection INTEGER,
-                        royalty REAL,
-                        green BOOLEAN,
-                        status TEXT,
-                        req_id TEXT,
-                        res_id TEXT,
-                        reg_txid TEXT,
-                        act_txid TEXT 
-                    )
-                ''')
-                await db.execute(f'''
-                    CREATE TABLE IF NOT EXISTS {self.cascade_table_name} (
-                        id INTEGER PRIMARY KEY,
-                        make_publicly_accessible BOOLEAN,
-                        status TEXT,
-                        req_id TEXT,
-                        res_id TEXT,
-                        reg_txid TEXT,
-                        act_txid TEXT
-                    )
-                ''')
-                await db.execute(f'''
-                    CREATE TABLE IF NOT EXISTS {self.sense_table_name} (
-                        id INTEGER PRIMARY KEY,
-                        collection_act_txid TEXT, 
-                        open_api_group_id TEXT,
-                        status TEXT,
-                        req_id TEXT,
-                        res_id TEXT,
-                        reg_txid TEXT,
-                        act_txid TEXT, 
-                        FOREIGN KEY(collection_act_txid) REFERENCES {self.collection_table_name}(act_txid)
-                    )
-                ''')
-                await db.execute(f'''
-                    CREATE TABLE IF NOT EXISTS {self.nft_table_name} (
-                        id INTEGER PRIMARY KEY,
-                        issued_copies INTEGER,
-                        royalty REAL,
-                        green BOOLEAN,
-                        collection_act_txid TEXT, 
-                        open_api_group_id TEXT,
-                        make_publicly_accessible BOOLEAN,
-                        status TEXT,
-                        req_id TEXT,
-                        res_id TEXT,
-                        reg_txid TEXT,
-                        act_txid TEXT, 
-                        FOREIGN KEY(collection_act_txid) REFERENCES {self.collection_table_name}(act_txid)
-                    )
-                ''')
-                await db.execute(f'''
-                    CREATE TABLE IF NOT EXISTS {self.images_table_name} (
-                    id INTEGER PRIMARY KEY,
-                    description TEXT NOT NULL,
-                    name TEXT,
-                    creator_name TEXT,
-                    keywords TEXT,
-                    series_name TEXT,
-                    file_path TEXT,
-                    cascade_id INTEGER,
-                    sense_id INTEGER,
-                    nft_id INTEGER,
-                    FOREIGN KEY(cascade_id) REFERENCES {self.cascade_table_name}(id),
-                    FOREIGN KEY(sense_id) REFERENCES {self.sense_table_name}(id),
-                    FOREIGN KEY(nft_id) REFERENCES {self.nft_table_name}(id)
-                    )
-                ''')
-
-                await db.commit()
+            await db_migrations.migrate(self)
         self.initialized = True
 
     async def add_image(self, description: str, name: str, file_path: str,
-                        creator_name: str = "pastel.network", keywords: str = None, series_name: str = None):
-        async with aiosqlite.connect(self.db_path) as db:
+                        creator_name: str = "pastel.network", keywords: str = None, series_name: str = None,
+                        phash: int = None):
+        async with self.pool.writer() as db:
             await db.execute(f"INSERT INTO {self.images_table_name} "
                              f"(description, name, file_path, "
-                             f"creator_name, keywords, series_name) "
-                             f"VALUES (?, ?, ?, ?, ?, ?)",
+                             f"creator_name, keywords, series_name, phash) "
+                             f"VALUES (?, ?, ?, ?, ?, ?, ?)",
                              (description, name, file_path,
-                              creator_name, keywords, series_name, ))
-            await db.commit()
+                              creator_name, keywords, series_name, phash, ))
+
+    async def read_submitted_phashes(self, after_id: int = 0) -> list:
+        """(id, image id, phash) of the images used for Sense or NFT after log id `after_id`, by any network."""
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT id, image_id, phash FROM submitted_phashes WHERE id > ? ORDER BY id",
+                                  (after_id, )) as cursor:
+                return await cursor.fetchall()
+
+    async def mark_near_duplicates(self, duplicates: list):
+        """Takes (img_id, id of the image it duplicates) pairs, also clears their Sense/NFT claim."""
+        async with self.pool.writer() as db:
+            await db.executemany(f"UPDATE {self.images_table_name} "
+                                 f"SET near_duplicate_of = ?, {SENSE_NFT_CLAIM}_claimed_by = NULL, "
+                                 f"{SENSE_NFT_CLAIM}_claim_expires = NULL WHERE id = ?",
+                                 [(duplicate_of, img_id) for img_id, duplicate_of in duplicates])
 
     async def read_all_images(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute(f"SELECT * FROM {self.images_table_name}") as cursor:
                 return await cursor.fetchall()
 
+    async def add_prompt_signatures(self, signatures: list) -> list:
+        """Returns the ids of the inserted signatures."""
+        ids = []
+        async with self.pool.writer() as db:
+            for signature in signatures:
+                async with db.execute("INSERT INTO prompt_signatures (signature) VALUES (?)", (signature, )) as cursor:
+                    ids.append(cursor.lastrowid)
+        return ids
+
+    async def read_prompt_signatures(self, after_id: int = 0) -> list:
+        """(id, signature) of the signatures added after `after_id`, by any process sharing the DB."""
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT id, signature FROM prompt_signatures WHERE id > ? ORDER BY id",
+                                  (after_id, )) as cursor:
+                return await cursor.fetchall()
+
     async def find_image_for_cascade(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute(f"SELECT * FROM {self.images_table_name} WHERE cascade_id IS NULL") as cursor:
                 return await cursor.fetchone()
 
     async def find_image_for_sense_or_nft(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute(f"SELECT * FROM {self.images_table_name} "
-                                  f"WHERE sense_id IS NULL AND nft_id is NULL") as cursor:
+                                  f"WHERE {SENSE_NFT_AVAILABLE}") as cursor:
                 return await cursor.fetchone()
 
+    async def number_of_images(self):
+        return await self._read_counter(self.images_table_name, 'total')
+
     async def number_of_images_for_cascade(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(f"SELECT COUNT(*) FROM {self.images_table_name} WHERE cascade_id IS NULL") as cursor:
-                return await cursor.fetchone()
+        return await self._read_counter(self.images_table_name, 'for_cascade')
 
     async def number_of_images_for_sense_or_nft(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(f"SELECT COUNT(*) FROM {self.images_table_name} "
-                                  f"WHERE sense_id IS NULL AND nft_id is NULL") as cursor:
+        return await self._read_counter(self.images_table_name, 'for_sense_or_nft')
+
+    async def _read_counter(self, table_name: str, key: str):
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT IFNULL(MAX(value), 0) FROM counters WHERE table_name = ? AND key = ?",
+                                  (table_name, key)) as cursor:
                 return await cursor.fetchone()
 
+    async def read_counters(self) -> dict:
+        """
+        All counts of this network in one read: {table name: {key: count}}. The images table has 'total',
+        'for_cascade' and 'for_sense_or_nft', ticket tables have one key per status, '' for tickets without one.
+        """
+        tables = [self.images_table_name, *db_migrations.ticket_tables(self)]
+        async with self.pool.reader() as db:
+            async with db.execute(f"SELECT table_name, key, value FROM counters "
+                                  f"WHERE table_name IN ({', '.join('?' * len(tables))})", tables) as cursor:
+                rows = await cursor.fetchall()
+        counters = {table_name: {} for table_name in tables}
+        for table_name, key, value in rows:
+            counters[table_name][key] = value
+        return counters
+
+    async def claim_images_for_cascade(self, worker_id: str, limit: int = 1, lease: int = None) -> list:
+        return await self._claim_images("cascade_id IS NULL", CASCADE_CLAIM, worker_id, limit, lease)
+
+    async def claim_images_for_sense_or_nft(self, worker_id: str, limit: int = 1, lease: int = None) -> list:
+        return await self._claim_images(SENSE_NFT_AVAILABLE, SENSE_NFT_CLAIM, worker_id, limit, lease)
+
+    async def release_cascade_claim(self, img_ids: list, worker_id: str):
+        await self._release_claim(CASCADE_CLAIM, img_ids, worker_id)
+
+    async def release_sense_or_nft_claim(self, img_ids: list, worker_id: str):
+        await self._release_claim(SENSE_NFT_CLAIM, img_ids, worker_id)
+
+    async def _claim_images(self, where: str, claim_name: str, worker_id: str, limit: int, lease: int | None) -> list:
+        """
+        Atomically marks up to `limit` unregistered images as taken by `worker_id` and returns them.
+        A claim expires after `lease` seconds, so images claimed by a crashed worker return to the queue.
+        """
+        now = time.time()
+        lease = settings.CLAIM_LEASE_SECONDS if lease is None else lease
+        async with self.pool.writer() as db:
+            async with db.execute(f"SELECT id FROM {self.images_table_name} "
+                                  f"WHERE {where} AND "
+                                  f"({claim_name}_claim_expires IS NULL OR {claim_name}_claim_expires < ?) "
+                                  f"ORDER BY id LIMIT ?",
+                                  (now, limit, )) as cursor:
+                img_ids = [row[0] for row in await cursor.fetchall()]
+            if not img_ids:
+                return []
+            placeholders = ', '.join(['?'] * len(img_ids))
+            await db.execute(f"UPDATE {self.images_table_name} "
+                             f"SET {claim_name}_claimed_by = ?, {claim_name}_claim_expires = ? "
+                             f"WHERE id IN ({placeholders})",
+                             (worker_id, now + lease, *img_ids))
+            async with db.execute(f"SELECT * FROM {self.images_table_name} WHERE id IN ({placeholders}) ORDER BY id",
+                                  img_ids) as cursor:
+                return await cursor.fetchall()
+
+    async def _release_claim(self, claim_name: str, img_ids: list, worker_id: str):
+        if not img_ids:
+            return
+        placeholders = ', '.join(['?'] * len(img_ids))
+        async with self.pool.writer() as db:
+            await db.execute(f"UPDATE {self.images_table_name} "
+                             f"SET {claim_name}_claimed_by = NULL, {claim_name}_claim_expires = NULL "
+                             f"WHERE {claim_name}_claimed_by = ? AND id IN ({placeholders})",
+                             (worker_id, *img_ids))
+
     async def add_cascade(self, img_id, res_status: str, req_id: str, res_id: str, reg_txid: str, act_txid: str,
-                          make_publicly_accessible: bool = True):
-        await self._add_ticket_record(self.cascade_table_name, 'cascade_id', img_id,
-                                      res_status, req_id, res_id, reg_txid, act_txid,
+                          make_publicly_accessible: bool = True, worker_id: str = None):
+        await self._add_ticket_record(self.cascade_table_name, 'cascade_id', CASCADE_CLAIM, img_id,
+                                      res_status, req_id, res_id, reg_txid, act_txid, worker_id,
                                       make_publicly_accessible=make_publicly_accessible)
 
     async def add_sense(self, img_id, res_status: str, req_id: str, res_id: str, reg_txid: str, act_txid: str,
-                        collection_act_txid: str = None, open_api_group_id: str = None):
-        await self._add_ticket_record(self.sense_table_name, 'sense_id', img_id,
-                                      res_status, req_id, res_id, reg_txid, act_txid,
+                        collection_act_txid: str = None, open_api_group_id: str = None, worker_id: str = None):
+        await self._add_ticket_record(self.sense_table_name, 'sense_id', SENSE_NFT_CLAIM, img_id,
+                                      res_status, req_id, res_id, reg_txid, act_txid, worker_id,
                                       collection_act_txid=collection_act_txid, open_api_group_id=open_api_group_id)
 
     async def add_nft(self, img_id, res_status: str, req_id: str, res_id: str, reg_txid: str, act_txid: str,
                       issued_copies: int, royalty: float, green: bool,
                       collection_act_txid: str = None, open_api_group_id: str = None,
-                      make_publicly_accessible: bool = True):
-        await self._add_ticket_record(self.nft_table_name, 'nft_id', img_id,
-                                      res_status, req_id, res_id, reg_txid, act_txid,
+                      make_publicly_accessible: bool = True, worker_id: str = None):
+        await self._add_ticket_record(self.nft_table_name, 'nft_id', SENSE_NFT_CLAIM, img_id,
+                                      res_status, req_id, res_id, reg_txid, act_txid, worker_id,
                                       issued_copies=issued_copies, royalty=royalty, green=green,
                                       collection_act_txid=collection_act_txid, open_api_group_id=open_api_group_id,
                                       make_publicly_accessible=make_publicly_accessible)
 
-    async def _add_ticket_record(self, table_name: str, img_col_name: str, img_id,
+    async def add_cascade_batch(self, records: list, make_publicly_accessible: bool = True, worker_id: str = None):
+        await self._add_ticket_records(self.cascade_table_name, 'cascade_id', CASCADE_CLAIM, records, worker_id,
+                                       make_publicly_accessible=make_publicly_accessible)
+
+    async def add_sense_batch(self, records: list, collection_act_txid: str = None, open_api_group_id: str = None,
+                              worker_id: str = None):
+        await self._add_ticket_records(self.sense_table_name, 'sense_id', SENSE_NFT_CLAIM, records, worker_id,
+                                       collection_act_txid=collection_act_txid, open_api_group_id=open_api_group_id)
+
+    async def _add_ticket_record(self, table_name: str, img_col_name: str, claim_name: str, img_id,
                                  res_status: str, req_id: str, res_id: str, reg_txid: str, act_txid: str,
-                                 **extra_fields):
-        placeholders = ', '.join(['?'] * (5 + len(extra_fields)))
-        field_names = ', '.join(['status', 'req_id', 'res_id', 'reg_txid', 'act_txid'] + list(extra_fields.keys()))
-        values = (res_status, req_id, res_id, reg_txid, act_txid) + tuple(extra_fields.values())
-
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(f"INSERT INTO {table_name} "
-                                      f"({field_names}) "
-                                      f"VALUES ({placeholders})",
-                                      values)
-            await db.commit()
-            record_id = cursor.lastrowid
-            await db.execute(f"UPDATE {self.images_table_name} SET {img_col_name} = ? WHERE id = ?",
-                             (record_id, img_id))
-            await db.commit()
+                                 worker_id: str = None, **extra_fields):
+        await self._add_ticket_records(table_name, img_col_name, claim_name,
+                                       [(img_id, res_status, req_id, res_id, reg_txid, act_txid)], worker_id,
+                                       **extra_fields)
+
+    async def _add_ticket_records(self, table_name: str, img_col_name: str, claim_name: str, records: list,
+                                  worker_id: str = None, **extra_fields):
+        """
+        Inserts one ticket row per record and links it to its image, all in one transaction.
+        `records` is a list of (img_id, res_status, req_id, res_id, reg_txid, act_txid) tuples,
+        `extra_fields` are stored in every row.
+        With `worker_id` an image is only linked while that worker still holds its claim - after the lease expired
+        another worker may have claimed and submitted it again, that one's ticket keeps the link.
+        """
+        if not records:
+            return
+        field_names = ['status', 'req_id', 'res_id', 'reg_txid', 'act_txid', 'check_count', 'next_check_at']
+        field_names += list(extra_fields.keys())
+        placeholders = ', '.join(['?'] * len(field_names))
+        now = time.time()
+
+        async with self.pool.writer() as db:
+            for img_id, res_status, req_id, res_id, reg_txid, act_txid in records:
+                values = (res_status, req_id, res_id, reg_txid, act_txid, 0, schedule_next_check(res_status, 0, now))
+                values += tuple(extra_fields.values())
+                cursor = await db.execute(f"INSERT INTO {table_name} "
+                                          f"({', '.join(field_names)}) "
+                                          f"VALUES ({placeholders})",
+                                          values)
+                record_id = cursor.lastrowid
+                # finalizes the claim: the ticket row and the image link are written in the same transaction
+                if worker_id is None:
+                    cursor = await db.execute(f"UPDATE {self.images_table_name} "
+                                              f"SET {img_col_name} = ?, {claim_name}_claimed_by = NULL, "
+                                              f"{claim_name}_claim_expires = NULL "
+                                              f"WHERE id = ?",
+                                              (record_id, img_id))
+                else:
+                    cursor = await db.execute(f"UPDATE {self.images_table_name} "
+                                              f"SET {img_col_name} = ?, {claim_name}_claimed_by = NULL, "
+                                              f"{claim_name}_claim_expires = NULL "
+                                              f"WHERE id = ? AND {claim_name}_claimed_by = ?",
+                                              (record_id, img_id, worker_id))
+                if cursor.rowcount == 0:
+                    logging.warning(f"DB: claim of image {img_id} by {worker_id} was lost before its {table_name} "
+                                    f"ticket {record_id} was recorded (lease expired?), the image is not linked "
+                                    f"to the ticket")
 
     async def update_cascade_status(self, ticket_id, status: str, reg_txid: str, act_txid: str):
         await self._update_status(self.cascade_table_name, ticket_id, status, reg_txid, act_txid)
@@ -215,10 +401,36 @@ class SQLiteDB:
         await self._update_status(self.collection_table_name, ticket_id, status, reg_txid, act_txid)
 
     async def _update_status(self, table_name: str, ticket_id, status: str, reg_txid: str, act_txid: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(f"UPDATE {table_name} SET status = ?, reg_txid = ?, act_txid = ? WHERE id = ?",
-                             (status, reg_txid, act_txid, ticket_id, ))
-            await db.commit()
+        await self._update_statuses(table_name, [(ticket_id, status, reg_txid, act_txid, 0)])
+
+    async def update_cascade_statuses(self, updates: list):
+        await self._update_statuses(self.cascade_table_name, updates)
+
+    async def update_sense_statuses(self, updates: list):
+        await self._update_statuses(self.sense_table_name, updates)
+
+    async def update_nft_statuses(self, updates: list):
+        await self._update_statuses(self.nft_table_name, updates)
+
+    async def update_collections_statuses(self, updates: list):
+        await self._update_statuses(self.collection_table_name, updates)
+
+    async def _update_statuses(self, table_name: str, updates: list):
+        """
+        Writes many poll results in one transaction.
+        `updates` is a list of (ticket_id, status, reg_txid, act_txid, check_count) tuples, where check_count is
+        the number of polls in a row that saw no change - the next poll time is derived from it.
+        """
+        if not updates:
+            return
+        now = time.time()
+        async with self.pool.writer() as db:
+            await db.executemany(f"UPDATE {table_name} "
+                                 f"SET status = ?, reg_txid = ?, act_txid = ?, check_count = ?, next_check_at = ? "
+                                 f"WHERE id = ?",
+                                 [(status, reg_txid, act_txid, check_count,
+                                   schedule_next_check(status, check_count, now), ticket_id)
+                                  for ticket_id, status, reg_txid, act_txid, check_count in updates])
 
     async def get_cascade_pending(self):
         return await self._get_pending_tickets(self.cascade_table_name)
@@ -233,11 +445,40 @@ class SQLiteDB:
         return await self._get_pending_tickets(self.collection_table_name)
 
     async def _get_pending_tickets(self, table_name: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(f"SELECT * FROM {table_name} WHERE status != 'SUCCESS'") as cursor:
+        """Returns the non-terminal tickets that are due for a status check."""
+        async with self.pool.reader() as db:
+            async with db.execute(f"SELECT * FROM {table_name} "
+                                  f"WHERE next_check_at IS NOT NULL AND next_check_at <= ?",
+                                  (time.time(), )) as cursor:
                 return await cursor.fetchall()
 
+    async def count_cascade_in_flight(self) -> int:
+        return await self._count_in_flight(self.cascade_table_name)
+
+    async def count_sense_in_flight(self) -> int:
+        return await self._count_in_flight(self.sense_table_name)
+
+    async def count_nft_in_flight(self) -> int:
+        return await self._count_in_flight(self.nft_table_name)
+
+    async def _count_in_flight(self, table_name: str) -> int:
+        """Counts the tickets that are not in a terminal state yet, i.e. still scheduled for polling."""
+        async with self.pool.reader() as db:
+            async with db.execute(f"SELECT COUNT(*) FROM {table_name} WHERE next_check_at IS NOT NULL") as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def next_check_due(self) -> float | None:
+        """Returns the earliest next_check_at of all ticket tables, or None if nothing has to be polled."""
+        async with self.pool.reader() as db:
+            due = []
+            for table_name in (self.cascade_table_name, self.sense_table_name, self.nft_table_name):
+                async with db.execute(f"SELECT MIN(next_check_at) FROM {table_name} "
+                                      f"WHERE next_check_at IS NOT NULL") as cursor:
+                    row = await cursor.fetchone()
+                    if row[0] is not None:
+                        due.append(row[0])
+            return min(due) if due else None
+
     async def get_cascade_counts(self):
         return await self._get_ticket_counts(self.cascade_table_name)
 
@@ -251,7 +492,7 @@ class SQLiteDB:
         return await self._get_ticket_counts(self.collection_table_name)
 
     async def _get_ticket_counts(self, table_name: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(f"SELECT status, COUNT(*) FROM {table_name} GROUP BY status") as cursor:
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT NULLIF(key, ''), value FROM counters "
+                                  "WHERE table_name = ? AND value > 0", (table_name, )) as cursor:
                 return await cursor.fetchall()
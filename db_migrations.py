@@ -0,0 +1,282 @@
+"""
+Versioned schema migrations for SQLiteDB.
+
+Every network keeps its own schema version in the `schema_version` table, because ticket tables are namespaced per
+network while the `images` table is shared by all networks living in the same file. For that reason every step must
+be idempotent (`IF NOT EXISTS`, `add_column`) - a step may find the shared objects already created by another network.
+
+To change the schema append a new step to MIGRATIONS, never edit an already released one.
+"""
+import logging
+import time
+
+
+async def add_column(db, table_name: str, column_name: str, column_def: str):
+    async with db.execute(f"PRAGMA table_info({table_name})") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if column_name not in columns:
+        await db.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_def}")
+
+
+def ticket_tables(tables) -> list[str]:
+    return [tables.cascade_table_name, tables.sense_table_name, tables.nft_table_name, tables.collection_table_name]
+
+
+async def _initial_schema(db, tables):
+    # collection_type is nft or sense
+    await db.execute(f'''
+        CREATE TABLE IF NOT EXISTS {tables.collection_table_name} (
+            id INTEGER PRIMARY KEY,
+            collection_type TEXT,
+            name TEXT,
+            max_collection_entries INTEGER,
+            collection_item_copy_count INTEGER,
+            list_of_pastelids_of_authorized_contributors TEXT,
+            max_permitted_open_nsfw_score REAL,
+            minimum_similarity_score_to_first_entry_in_collection REAL,
+            no_of_days_to_finalize_collection INTEGER,
+            royalty REAL,
+            green BOOLEAN,
+            status TEXT,
+            req_id TEXT,
+            res_id TEXT,
+            reg_txid TEXT,
+            act_txid TEXT 
+        )
+    ''')
+    await db.execute(f'''
+        CREATE TABLE IF NOT EXISTS {tables.cascade_table_name} (
+            id INTEGER PRIMARY KEY,
+            make_publicly_accessible BOOLEAN,
+            status TEXT,
+            req_id TEXT,
+            res_id TEXT,
+            reg_txid TEXT,
+            act_txid TEXT
+        )
+    ''')
+    await db.execute(f'''
+        CREATE TABLE IF NOT EXISTS {tables.sense_table_name} (
+            id INTEGER PRIMARY KEY,
+            collection_act_txid TEXT, 
+            open_api_group_id TEXT,
+            status TEXT,
+            req_id TEXT,
+            res_id TEXT,
+            reg_txid TEXT,
+            act_txid TEXT, 
+            FOREIGN KEY(collection_act_txid) REFERENCES {tables.collection_table_name}(act_txid)
+        )
+    ''')
+    await db.execute(f'''
+        CREATE TABLE IF NOT EXISTS {tables.nft_table_name} (
+            id INTEGER PRIMARY KEY,
+            issued_copies INTEGER,
+            royalty REAL,
+            green BOOLEAN,
+            collection_act_txid TEXT, 
+            open_api_group_id TEXT,
+            make_publicly_accessible BOOLEAN,
+            status TEXT,
+            req_id TEXT,
+            res_id TEXT,
+            reg_txid TEXT,
+            act_txid TEXT, 
+            FOREIGN KEY(collection_act_txid) REFERENCES {tables.collection_table_name}(act_txid)
+        )
+    ''')
+    await db.execute(f'''
+        CREATE TABLE IF NOT EXISTS {tables.images_table_name} (
+        id INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        name TEXT,
+        creator_name TEXT,
+        keywords TEXT,
+        series_name TEXT,
+        file_path TEXT,
+        cascade_id INTEGER,
+        sense_id INTEGER,
+        nft_id INTEGER,
+        FOREIGN KEY(cascade_id) REFERENCES {tables.cascade_table_name}(id),
+        FOREIGN KEY(sense_id) REFERENCES {tables.sense_table_name}(id),
+        FOREIGN KEY(nft_id) REFERENCES {tables.nft_table_name}(id)
+        )
+    ''')
+
+
+async def _status_and_queue_indexes(db, tables):
+    # partial indexes matching the exact predicates of find_image_for_* and number_of_images_for_*
+    await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{tables.images_table_name}_for_cascade "
+                     f"ON {tables.images_table_name}(id) WHERE cascade_id IS NULL")
+    await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{tables.images_table_name}_for_sense_or_nft "
+                     f"ON {tables.images_table_name}(id) WHERE sense_id IS NULL AND nft_id IS NULL")
+    for table_name in ticket_tables(tables):
+        # covering index for GROUP BY status and partial index for the pending tickets query
+        await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_status ON {table_name}(status)")
+        await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_pending "
+                         f"ON {table_name}(id) WHERE status != 'SUCCESS'")
+
+
+async def _image_claims(db, tables):
+    for claim_name in ('cascade', 'sense_nft'):
+        await add_column(db, tables.images_table_name, f"{claim_name}_claimed_by", "TEXT")
+        await add_column(db, tables.images_table_name, f"{claim_name}_claim_expires", "REAL")
+
+
+async def _poll_schedule(db, tables):
+    terminal = "('SUCCESS', 'FAILED', 'ERROR')"
+    for table_name in ticket_tables(tables):
+        await add_column(db, table_name, "check_count", "INTEGER NOT NULL DEFAULT 0")
+        await add_column(db, table_name, "next_check_at", "REAL")
+        # existing non-terminal tickets are due right away, terminal ones are never polled again
+        await db.execute(f"UPDATE {table_name} SET next_check_at = 0 "
+                         f"WHERE next_check_at IS NULL AND (status IS NULL OR status NOT IN {terminal})")
+        await db.execute(f"DROP INDEX IF EXISTS idx_{table_name}_pending")
+        await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_next_check "
+                         f"ON {table_name}(next_check_at) WHERE next_check_at IS NOT NULL")
+
+
+async def _prompt_signatures(db, tables):
+    # shared by all networks like the images table, a description is a duplicate whatever network it was used on
+    await db.execute("CREATE TABLE IF NOT EXISTS prompt_signatures ("
+                     "id INTEGER PRIMARY KEY, "
+                     "signature BLOB NOT NULL)")
+
+
+async def _perceptual_hashes(db, tables):
+    await add_column(db, tables.images_table_name, "phash", "INTEGER")
+    # id of the already submitted image this one is a near-duplicate of, such images are not used for Sense/NFT
+    await add_column(db, tables.images_table_name, "near_duplicate_of", "INTEGER")
+    await db.execute(f"DROP INDEX IF EXISTS idx_{tables.images_table_name}_for_sense_or_nft")
+    await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{tables.images_table_name}_for_sense_or_nft "
+                     f"ON {tables.images_table_name}(id) "
+                     f"WHERE sense_id IS NULL AND nft_id IS NULL AND near_duplicate_of IS NULL")
+
+
+async def _submitted_phashes(db, tables):
+    # append-only log of the perceptual hashes of images used for Sense or NFT, read by id so every process and
+    # network learns about the submissions of the others without rescanning the images table
+    images = tables.images_table_name
+    await db.execute("CREATE TABLE IF NOT EXISTS submitted_phashes ("
+                     "id INTEGER PRIMARY KEY, "
+                     "image_id INTEGER NOT NULL, "
+                     "phash INTEGER NOT NULL)")
+    await db.execute(f"CREATE TRIGGER IF NOT EXISTS {images}_submitted_phash "
+                     f"AFTER UPDATE OF sense_id, nft_id ON {images} "
+                     f"WHEN NEW.phash IS NOT NULL AND OLD.sense_id IS NULL AND OLD.nft_id IS NULL "
+                     f"AND (NEW.sense_id IS NOT NULL OR NEW.nft_id IS NOT NULL) BEGIN "
+                     f"INSERT INTO submitted_phashes (image_id, phash) VALUES (NEW.id, NEW.phash); END")
+    await db.execute(f"INSERT INTO submitted_phashes (image_id, phash) "
+                     f"SELECT id, phash FROM {images} "
+                     f"WHERE phash IS NOT NULL AND (sense_id IS NOT NULL OR nft_id IS NOT NULL) "
+                     f"AND id NOT IN (SELECT image_id FROM submitted_phashes) ORDER BY id")
+
+
+async def _counters(db, tables):
+    """
+    Image and ticket counts kept up to date by triggers in the same transaction as the change, so statistics and
+    backlogs are read from a few rows instead of scanning the tables. Every step recounts from the tables, a
+    recount after another network created the shared image triggers gives the same numbers.
+    """
+    await db.execute("CREATE TABLE IF NOT EXISTS counters ("
+                     "table_name TEXT NOT NULL, "
+                     "key TEXT NOT NULL, "
+                     "value INTEGER NOT NULL DEFAULT 0, "
+                     "PRIMARY KEY (table_name, key))")
+
+    images = tables.images_table_name
+    # images: total, available for Cascade and available for Sense/NFT - the predicates of number_of_images_for_*
+    for_cascade = "{row}.cascade_id IS NULL"
+    for_sense_or_nft = "{row}.sense_id IS NULL AND {row}.nft_id IS NULL AND {row}.near_duplicate_of IS NULL"
+
+    def image_deltas(row, sign):
+        return (f"CASE key WHEN 'total' THEN {sign}1 "
+                f"WHEN 'for_cascade' THEN {sign}({for_cascade.format(row=row)}) "
+                f"WHEN 'for_sense_or_nft' THEN {sign}({for_sense_or_nft.format(row=row)}) ELSE 0 END")
+
+    await db.execute(f"CREATE TRIGGER IF NOT EXISTS {images}_counters_insert AFTER INSERT ON {images} BEGIN "
+                     f"UPDATE counters SET value = value + {image_deltas('NEW', '+')} "
+                     f"WHERE table_name = '{images}'; END")
+    await db.execute(f"CREATE TRIGGER IF NOT EXISTS {images}_counters_delete AFTER DELETE ON {images} BEGIN "
+                     f"UPDATE counters SET value = value + {image_deltas('OLD', '-')} "
+                     f"WHERE table_name = '{images}'; END")
+    # claims and phash updates do not touch these columns and do not fire the trigger
+    await db.execute(f"CREATE TRIGGER IF NOT EXISTS {images}_counters_update "
+                     f"AFTER UPDATE OF cascade_id, sense_id, nft_id, near_duplicate_of ON {images} BEGIN "
+                     f"UPDATE counters SET value = value + {image_deltas('NEW', '+')} + {image_deltas('OLD', '-')} "
+                     f"WHERE table_name = '{images}'; END")
+    await db.execute(f"INSERT OR REPLACE INTO counters (table_name, key, value) "
+                     f"SELECT '{images}', 'total', COUNT(*) FROM {images} "
+                     f"UNION ALL SELECT '{images}', 'for_cascade', COUNT(*) FROM {images} "
+                     f"WHERE {for_cascade.format(row=images)} "
+                     f"UNION ALL SELECT '{images}', 'for_sense_or_nft', COUNT(*) FROM {images} "
+                     f"WHERE {for_sense_or_nft.format(row=images)}")
+
+    # tickets: count per status, a NULL status is counted under ''
+    for table_name in ticket_tables(tables):
+        increment = (f"INSERT INTO counters (table_name, key, value) VALUES ('{table_name}', IFNULL(NEW.status, ''), 1) "
+                     f"ON CONFLICT (table_name, key) DO UPDATE SET value = value + 1;")
+        decrement = (f"UPDATE counters SET value = value - 1 "
+                     f"WHERE table_name = '{table_name}' AND key = IFNULL(OLD.status, '');")
+        await db.execute(f"CREATE TRIGGER IF NOT EXISTS {table_name}_counters_insert "
+                         f"AFTER INSERT ON {table_name} BEGIN {increment} END")
+        await db.execute(f"CREATE TRIGGER IF NOT EXISTS {table_name}_counters_delete "
+                         f"AFTER DELETE ON {table_name} BEGIN {decrement} END")
+        await db.execute(f"CREATE TRIGGER IF NOT EXISTS {table_name}_counters_update "
+                         f"AFTER UPDATE OF status ON {table_name} WHEN OLD.status IS NOT NEW.status "
+                         f"BEGIN {decrement} {increment} END")
+        await db.execute("DELETE FROM counters WHERE table_name = ?", (table_name, ))
+        await db.execute(f"INSERT INTO counters (table_name, key, value) "
+                         f"SELECT '{table_name}', IFNULL(status, ''), COUNT(*) FROM {table_name} "
+                         f"GROUP BY IFNULL(status, '')")
+
+
+# (version, description, step) - applied in order, each one in its own transaction
+MIGRATIONS = [
+    (1, "initial schema", _initial_schema),
+    (2, "indexes for image queue and ticket status queries", _status_and_queue_indexes),
+    (3, "claim columns for the image work queue", _image_claims),
+    (4, "per-ticket poll schedule", _poll_schedule),
+    (5, "MinHash signatures of image descriptions", _prompt_signatures),
+    (6, "perceptual hashes of images", _perceptual_hashes),
+    (7, "log of the perceptual hashes of submitted images", _submitted_phashes),
+    (8, "trigger maintained image and ticket counters", _counters),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def _ensure_version_table(db):
+    await db.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+                     "namespace TEXT PRIMARY KEY, "
+                     "version INTEGER NOT NULL, "
+                     "applied_at REAL)")
+
+
+async def get_schema_version(tables) -> int:
+    async with tables.pool.reader() as db:
+        async with db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_version'") as cursor:
+            if not await cursor.fetchone():
+                return 0
+        async with db.execute("SELECT version FROM schema_version WHERE namespace = ?",
+                              (tables.network_name, )) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+
+async def migrate(tables):
+    for version, description, step in MIGRATIONS:
+        async with tables.pool.writer() as db:
+            await _ensure_version_table(db)
+            # re-read the version inside the write transaction, another process may have migrated already
+            async with db.execute("SELECT version FROM schema_version WHERE namespace = ?",
+                                  (tables.network_name, )) as cursor:
+                row = await cursor.fetchone()
+            if row and row[0] >= version:
+                continue
+            logging.info(f"DB: applying migration {version} ({description}) for {tables.network_name}")
+            await step(db, tables)
+            await db.execute("INSERT INTO schema_version (namespace, version, applied_at) VALUES (?, ?, ?) "
+                             "ON CONFLICT(namespace) DO UPDATE SET version = excluded.version, "
+                             "applied_at = excluded.applied_at",
+                             (tables.network_name, version, time.time()))
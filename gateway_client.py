@@ -0,0 +1,272 @@
+import asyncio
+from collections import deque
+import functools
+import inspect
+import logging
+import random
+import time
+
+import aiohttp
+from pastel_gateway_sdk import GatewayApiClientAsync
+from pastel_gateway_sdk.rest import ApiException
+
+from config import settings
+
+
+# HTTP statuses worth retrying. Process requests are not idempotent, they are only retried when the gateway
+# tells us it did not accept the request at all
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_STATUSES_NOT_IDEMPOTENT = (429, 503)
+
+
+class CircuitOpenError(ApiException):
+    def __init__(self, retry_in: float):
+        super().__init__(status=503, reason=f"Gateway circuit breaker is open, retry in {retry_in:.0f} secs")
+        self.retry_in = retry_in
+
+
+class TokenBucket:
+    """Token bucket rate limiter: `rate` requests per second with bursts of up to `capacity` requests."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """
+    Opens when the error rate of the calls made in the last `window` seconds reaches `threshold`
+    (given at least `min_calls` calls), stays open for `cooldown` seconds and then lets a single probe call
+    through in half-open state - its success closes it, its failure opens it again. Other calls are rejected
+    until the probe has resolved.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold: float, min_calls: int, window: float, cooldown: float):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self._calls = deque()
+        self._opened_at = None
+        self._probing = False
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def allow(self) -> bool:
+        """Whether a call may go out now, in half-open state the first caller becomes the probe."""
+        state = self.state
+        if state == self.OPEN:
+            return False
+        if state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def release_probe(self):
+        """The probe ended without an answer (cancelled), the next caller probes instead."""
+        self._probing = False
+
+    def retry_in(self) -> float:
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+
+    def error_rate(self) -> float:
+        self._trim()
+        if not self._calls:
+            return 0.0
+        return sum(1 for _, ok in self._calls if not ok) / len(self._calls)
+
+    def record(self, ok: bool):
+        state = self.state
+        now = time.monotonic()
+        self._calls.append((now, ok))
+        self._trim()
+        if state == self.HALF_OPEN:
+            if ok:
+                self._close()
+            else:
+                self._open()
+        elif state == self.CLOSED and not ok:
+            if len(self._calls) >= self.min_calls and self.error_rate() >= self.threshold:
+                self._open()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self.times_opened += 1
+        logging.warning(f"Gateway circuit breaker opened, error rate {self.error_rate():.0%}, "
+                        f"pausing for {self.cooldown} secs")
+
+    def _close(self):
+        self._opened_at = None
+        self._probing = False
+        self._calls.clear()
+        logging.info("Gateway circuit breaker closed")
+
+    def _trim(self):
+        cutoff = time.monotonic() - self.window
+        while self._calls and self._calls[0][0] < cutoff:
+            self._calls.popleft()
+
+
+class _ApiProxy:
+    """Wraps every coroutine method of an SDK API object with GatewayClient.call"""
+    def __init__(self, api, gateway: "GatewayClient"):
+        self._api = api
+        self._gateway = gateway
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            return await self._gateway.call(name, attr, *args, **kwargs)
+
+        return wrapper
+
+
+class GatewayClient:
+    """
+    GatewayApiClientAsync with per-endpoint token bucket rate limits, retries with jittered exponential
+    backoff and a circuit breaker shared by all endpoints. Exposes the same `cascade_api`, `sense_api`
+    and `nft_api` attributes as the SDK client.
+    """
+    def __init__(self, network: str, api_key: str, custom_url: str = None):
+        self.client = GatewayApiClientAsync(network=network, custom_url=custom_url)
+        self.client.set_auth_api_key(api_key)
+        self.breaker = CircuitBreaker(settings.GATEWAY_BREAKER_ERROR_RATE, settings.GATEWAY_BREAKER_MIN_CALLS,
+                                      settings.GATEWAY_BREAKER_WINDOW, settings.GATEWAY_BREAKER_COOLDOWN)
+        self._buckets = {}
+        self._proxies = {}
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+
+    @property
+    def cascade_api(self):
+        return self._proxy("cascade_api")
+
+    @property
+    def sense_api(self):
+        return self._proxy("sense_api")
+
+    @property
+    def nft_api(self):
+        return self._proxy("nft_api")
+
+    @property
+    def collection_api(self):
+        return self._proxy("collection_api")
+
+    def _proxy(self, name: str):
+        if name not in self._proxies:
+            self._proxies[name] = _ApiProxy(getattr(self.client, name), self)
+        return self._proxies[name]
+
+    def _bucket(self, endpoint: str) -> TokenBucket:
+        if endpoint not in self._buckets:
+            if endpoint.endswith("process_request"):
+                rate = settings.GATEWAY_RATE_LIMIT_PROCESS
+            elif endpoint.endswith("get_result"):
+                rate = settings.GATEWAY_RATE_LIMIT_RESULT
+            else:
+                rate = settings.GATEWAY_RATE_LIMIT_DEFAULT
+            self._buckets[endpoint] = TokenBucket(rate, settings.GATEWAY_RATE_BURST)
+        return self._buckets[endpoint]
+
+    @staticmethod
+    def _is_gateway_failure(error: Exception) -> bool:
+        """Transport errors, timeouts and RETRYABLE_STATUSES count for the breaker, other 4xx answers do not."""
+        if isinstance(error, ApiException) and error.status is not None:
+            return error.status in RETRYABLE_STATUSES
+        return True
+
+    @staticmethod
+    def _is_retryable(error: Exception, idempotent: bool) -> bool:
+        if isinstance(error, CircuitOpenError):
+            return False
+        if isinstance(error, ApiException):
+            if error.status is None:
+                return idempotent
+            return error.status in (RETRYABLE_STATUSES if idempotent else RETRYABLE_STATUSES_NOT_IDEMPOTENT)
+        # connection problems - the request may have reached the gateway
+        return idempotent
+
+    async def call(self, endpoint: str, func, *args, **kwargs):
+        idempotent = not endpoint.endswith("process_request")
+        attempt = 0
+        while True:
+            probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+            if not self.breaker.allow():
+                raise CircuitOpenError(self.breaker.retry_in())
+            try:
+                await self._bucket(endpoint).acquire()
+                self.calls += 1
+                result = await func(*args, **kwargs)
+            except (ApiException, aiohttp.ClientError, asyncio.TimeoutError) as error:
+                self.failures += 1
+                # a 4xx answer means the gateway works, the request was wrong
+                self.breaker.record(not self._is_gateway_failure(error))
+                if attempt >= settings.GATEWAY_MAX_RETRIES or not self._is_retryable(error, idempotent):
+                    raise
+                attempt += 1
+                self.retries += 1
+                delay = min(settings.GATEWAY_BACKOFF_MAX, settings.GATEWAY_BACKOFF_BASE * 2 ** (attempt - 1))
+                delay = random.uniform(0, delay)
+                logging.info(f"Gateway {endpoint} failed ({error.__class__.__name__}), "
+                             f"retry {attempt} in {delay:.1f} secs")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                if probe:
+                    self.breaker.release_probe()
+                raise
+            self.breaker.record(True)
+            return result
+
+    def stats(self) -> dict:
+        return {
+            'circuit breaker': self.breaker.state,
+            'retry in (secs)': round(self.breaker.retry_in()),
+            'error rate': f"{self.breaker.error_rate():.0%}",
+            'times opened': self.breaker.times_opened,
+            'calls': self.calls,
+            'failures': self.failures,
+            'retries': self.retries,
+        }
+
+    async def close(self):
+        await self.client.close()
@@ -0,0 +1,40 @@
+from contextlib import contextmanager
+import asyncio
+import time
+
+
+class PipelineStage:
+    """
+    Bookkeeping of one stage of the image generation pipeline.
+
+    Attributes:
+        name (str): name shown in the statistics.
+        workers (int): number of concurrent workers running the stage.
+        output (asyncio.Queue | None): bounded queue the stage feeds, None for the last stage.
+    """
+    def __init__(self, name: str, workers: int, output: asyncio.Queue = None):
+        self.name = name
+        self.workers = max(1, workers)
+        self.output = output
+        self.items = 0
+        self.busy_secs = 0.0
+        self.active = 0
+        self._started = time.monotonic()
+
+    @contextmanager
+    def busy(self):
+        """Times the actual work of a worker, time spent waiting on the queues is not counted."""
+        self.active += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.busy_secs += time.monotonic() - start
+            self.active -= 1
+
+    def stats(self) -> str:
+        elapsed = max(1e-6, (time.monotonic() - self._started) * self.workers)
+        stats = f"{self.items} done, busy {100 * self.busy_secs / elapsed:.0f}%, {self.active}/{self.workers} working"
+        if self.output is not None:
+            stats += f", queue {self.output.qsize()}/{self.output.maxsize}"
+        return stats
@@ -1,8 +1,15 @@
-from diffusers import StableDiffusionPipeline, EulerDiscreteScheduler
+from contextlib import nullcontext
+import logging
+import time
+
+from diffusers import StableDiffusionPipeline, EulerDiscreteScheduler, DPMSolverMultistepScheduler
 import torch
 from compel import Compel
 
-from config import settings
+from config import settings, SD_PRESETS
+
+
+SCHEDULERS = {scheduler.__name__: scheduler for scheduler in (EulerDiscreteScheduler, DPMSolverMultistepScheduler)}
 
 
 class SDImageGenerator:
@@ -14,20 +21,111 @@ class SDImageGenerator:
         scheduler = EulerDiscreteScheduler.from_pretrained(settings.IMAGE_MODEL_ID, subfolder="scheduler")
         self.pipe = StableDiffusionPipeline.from_pretrained(settings.IMAGE_MODEL_ID,
                                                             scheduler=scheduler, torch_dtype=dtype)
+        self.use_bf16 = False
+        self.preset = None
+        self.scheduler_config = scheduler.config
+        self._schedulers = {EulerDiscreteScheduler: scheduler}
+        self.preset_timings = {}
         if settings.USE_GPU:
             self.pipe = self.pipe.to("cuda")
+        else:
+            self._optimize_for_cpu()
         self.compel = Compel(tokenizer=self.pipe.tokenizer, text_encoder=self.pipe.text_encoder)
         self.negative_conditioning = self.compel(settings.IMAGE_NEGATIVE_PROMPT)
+        if settings.SD_CPU_COMPILE and not settings.USE_GPU:
+            self._warm_up()
 
-    def generate(self, prompt, file_name):
+    @staticmethod
+    def _bf16_supported() -> bool:
+        try:
+            return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+        except (AttributeError, RuntimeError):
+            return False
+
+    def _optimize_for_cpu(self):
+        """Applies the SD_CPU_* options, see benchmark_sd.py for their effect on seconds/image."""
+        if settings.SD_CPU_THREADS > 0:
+            torch.set_num_threads(settings.SD_CPU_THREADS)
+        if settings.SD_CPU_BF16:
+            self.use_bf16 = self._bf16_supported()
+            if not self.use_bf16:
+                logging.info("SDImageGenerator: bfloat16 is not supported by this CPU, using float32")
+        if settings.SD_CPU_CHANNELS_LAST:
+            self.pipe.unet.to(memory_format=torch.channels_last)
+            self.pipe.vae.to(memory_format=torch.channels_last)
+        if settings.SD_CPU_ATTENTION_SLICING:
+            self.pipe.enable_attention_slicing()
+        if settings.SD_CPU_QUANTIZE_TEXT_ENCODER:
+            self.pipe.text_encoder = torch.ao.quantization.quantize_dynamic(self.pipe.text_encoder,
+                                                                            {torch.nn.Linear}, dtype=torch.qint8)
+        if settings.SD_CPU_COMPILE:
+            self._compile()
+
+    def _compile(self):
+        self.pipe.unet = torch.compile(self.pipe.unet)
+        self.pipe.vae.decode = torch.compile(self.pipe.vae.decode)
+
+    def _warm_up(self):
+        # torch.compile traces on the first call, do it with the real batch shape before the first real image
+        logging.info("SDImageGenerator: compiling UNet and VAE...")
+        batch_size = max(1, settings.SD_BATCH_SIZE)
+        self._render(["warm up"] * batch_size, images_per_prompt=1, steps=2)
+
+    @staticmethod
+    def _prepare_prompt(prompt: str) -> str:
         prompt_parts = prompt.split(". ")
         if len(prompt_parts) > 1:
             prompt = "(" + ', '.join(['"' + s + '"' for s in prompt_parts]) + ").add"
-        conditioning = self.compel(prompt)
-        [conditioning, negative_conditioning] = self.compel.pad_conditioning_tensors_to_same_length(
-            [conditioning, self.negative_conditioning])
-        image = self.pipe(
-            prompt_embeds=conditioning,
-            negative_propmt_embeds=negative_conditioning,
-            num_inference_steps=settings.SD_ITERATIONS).images[0]
-        image.save(file_name)
+        return prompt
+
+    def generate(self, prompt, file_name):
+        self.generate_batch([prompt], [file_name])
+
+    def generate_batch(self, prompts: list, file_names: list):
+        """
+        Renders all prompts in one pipeline call. `file_names` holds the same number of names for every prompt,
+        grouped by prompt - with more names than prompts each prompt is rendered num_images_per_prompt times.
+        """
+        images_per_prompt = max(1, len(file_names) // len(prompts))
+        preset_name, steps, guidance = self._apply_preset()
+        start = time.perf_counter()
+        images = self._render(prompts, images_per_prompt, steps, guidance)
+        count, secs = self.preset_timings.get(preset_name, (0, 0.0))
+        self.preset_timings[preset_name] = (count + len(images), secs + time.perf_counter() - start)
+        for image, file_name in zip(images, file_names):
+            image.save(file_name)
+
+    def _apply_preset(self) -> (str, int, float):
+        """
+        Switches the pipeline to the SD_PRESET scheduler if it has changed since the last render.
+        Runs in the render thread, so a preset changed from the web UI never swaps the scheduler mid-render;
+        the model weights stay loaded, only the scheduler object is replaced.
+        """
+        preset_name = settings.SD_PRESET if settings.SD_PRESET in SD_PRESETS else "quality"
+        preset = SD_PRESETS[preset_name]
+        if preset_name != self.preset:
+            scheduler_class = SCHEDULERS[preset["scheduler"]]
+            if scheduler_class not in self._schedulers:
+                self._schedulers[scheduler_class] = scheduler_class.from_config(self.scheduler_config)
+            self.pipe.scheduler = self._schedulers[scheduler_class]
+            self.preset = preset_name
+            logging.info(f"SDImageGenerator: using {preset_name} preset ({scheduler_class.__name__})")
+        return preset_name, preset["steps"] or settings.SD_ITERATIONS, preset["guidance"]
+
+    def preset_stats(self) -> dict:
+        return {name: f"{count} images, {secs / count:.1f} secs/image"
+                for name, (count, secs) in self.preset_timings.items() if count}
+
+    def _render(self, prompts: list, images_per_prompt: int, steps: int, guidance: float = 7.5) -> list:
+        conditionings = [self.compel(self._prepare_prompt(prompt)) for prompt in prompts]
+        padded = self.compel.pad_conditioning_tensors_to_same_length(conditionings + [self.negative_conditioning])
+        conditioning = torch.cat(padded[:-1])
+        negative_conditioning = padded[-1].repeat(len(prompts), 1, 1)
+        autocast = torch.autocast("cpu", dtype=torch.bfloat16) if self.use_bf16 else nullcontext()
+        with torch.inference_mode(), autocast:
+            return self.pipe(
+                prompt_embeds=conditioning,
+                negative_prompt_embeds=negative_conditioning,
+                num_images_per_prompt=images_per_prompt,
+                num_inference_steps=steps,
+                guidance_scale=guidance).images
@@ -0,0 +1,133 @@
+import asyncio
+
+from PIL import Image
+
+
+HASH_BITS = 64
+
+
+def perceptual_hash(file_path: str) -> int | None:
+    """
+    64 bit difference hash: the image is scaled down to 9x8 grey pixels and every bit tells whether a pixel is
+    brighter than its right neighbour. Re-encoding, small colour or detail changes flip only a few bits.
+    """
+    try:
+        with Image.open(file_path) as image:
+            pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def to_db(value: int | None) -> int | None:
+    """SQLite integers are signed 64 bit."""
+    if value is None:
+        return None
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def from_db(value: int | None) -> int | None:
+    if value is None:
+        return None
+    return value & ((1 << HASH_BITS) - 1)
+
+
+class HammingIndex:
+    """
+    Finds hashes within `max_distance` differing bits by multi-index hashing: the 64 bits are split into
+    max_distance + 1 chunks and every chunk value has its own bucket. Two hashes differing in at most max_distance
+    bits have at least one identical chunk (pigeonhole), so only hashes sharing a bucket with the query are
+    compared. That keeps a lookup among hundreds of thousands of hashes at a few thousand comparisons, where a
+    BK-tree visits a large part of the tree because distances between unrelated hashes cluster around 32.
+    """
+    def __init__(self, max_distance: int):
+        self.max_distance = max(0, max_distance)
+        parts = min(HASH_BITS, self.max_distance + 1)
+        bounds = [HASH_BITS * part // parts for part in range(parts + 1)]
+        self._chunks = [(low, (1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]
+        self._buckets = [{} for _ in self._chunks]
+        self._entries = []
+        self._items = {}
+
+    def add(self, value: int, item):
+        index = len(self._entries)
+        self._entries.append((value, item))
+        self._items.setdefault(item, []).append(index)
+        for buckets, (shift, mask) in zip(self._buckets, self._chunks):
+            buckets.setdefault((value >> shift) & mask, []).append(index)
+
+    def remove(self, item):
+        """Removes every hash added for `item`."""
+        for index in self._items.pop(item, ()):
+            value, _ = self._entries[index]
+            self._entries[index] = None
+            for buckets, (shift, mask) in zip(self._buckets, self._chunks):
+                key = (value >> shift) & mask
+                buckets[key].remove(index)
+                if not buckets[key]:
+                    del buckets[key]
+
+    def find(self, value: int) -> list:
+        """Returns (distance, item) for every item within max_distance, closest first."""
+        candidates = set()
+        for buckets, (shift, mask) in zip(self._buckets, self._chunks):
+            candidates.update(buckets.get((value >> shift) & mask, ()))
+        found = []
+        for index in candidates:
+            other, item = self._entries[index]
+            distance = (other ^ value).bit_count()
+            if distance <= self.max_distance:
+                found.append((distance, item))
+        return sorted(found, key=lambda pair: pair[0])
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SubmittedImageIndex:
+    """
+    Perceptual hashes of the images submitted to Sense or NFT, shared by the NetworkMakers of a process.
+
+    Submissions of every network and process sharing the DB are read from its `submitted_phashes` log by id,
+    `seen` is the last id read. An image that passed the near-duplicate check is reserved until its submission
+    is recorded or has failed, so concurrent submitters never both pass near-duplicates of each other.
+    """
+    def __init__(self, max_distance: int):
+        self.hashes = HammingIndex(max_distance)
+        self.seen = 0
+        self.reserved = set()
+        self.lock = asyncio.Lock()
+
+    def add_submitted(self, value: int, img_id: int):
+        if img_id in self.hashes:
+            # the reservation turned into a recorded submission, a failure reported later must not remove it
+            self.reserved.discard(img_id)
+            return
+        self.hashes.add(value, img_id)
+
+    def find(self, value: int, img_id: int) -> list:
+        """(distance, image id) of the submitted or reserved images near `value`, other than `img_id`."""
+        return [(distance, other) for distance, other in self.hashes.find(value) if other != img_id]
+
+    def reserve(self, value: int, img_id: int):
+        self.hashes.add(value, img_id)
+        self.reserved.add(img_id)
+
+    def confirm(self, img_ids: list):
+        self.reserved.difference_update(img_ids)
+
+    def release(self, img_ids: list):
+        for img_id in img_ids:
+            if img_id in self.reserved:
+                self.reserved.discard(img_id)
+                self.hashes.remove(img_id)
+
+    def __len__(self):
+        return len(self.hashes)
@@ -0,0 +1,116 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import torch
+
+from config import settings
+from image_generator import SDImageGenerator
+
+
+# the pipeline loaded by the parent process, worker processes inherit it through fork
+_generator: SDImageGenerator | None = None
+
+
+def _init_worker(threads: int):
+    torch.set_num_threads(threads)
+    if settings.SD_CPU_COMPILE and not settings.USE_GPU:
+        # the parent loaded the pipeline without compiling, every worker compiles its own copy
+        _generator._compile()
+        _generator._warm_up()
+
+
+def _worker_ready() -> int:
+    return os.getpid()
+
+
+def _render_job(prompts: list, file_names: list, preset: str) -> dict:
+    # settings changed from the web UI after the fork only reach the workers through the job
+    settings.SD_PRESET = preset
+    return _render(prompts, file_names)
+
+
+def _render(prompts: list, file_names: list) -> dict:
+    start = time.perf_counter()
+    _generator.generate_batch(prompts, file_names)
+    return {"file_names": file_names, "preset": _generator.preset, "secs": time.perf_counter() - start,
+            "pid": os.getpid()}
+
+
+class ProcessImageGenerator:
+    """
+    Renders images in SD_WORKER_PROCESSES worker processes instead of threads of the main process, so the
+    renderers do not share the GIL and the torch thread pool with the LLM, the event loop and each other.
+
+    The pipeline is loaded once in the main process and the workers are forked right after that, so the model
+    weights are shared copy-on-write - the tensors are never written during inference - and N workers do not cost
+    N times the RAM. Fork does not work with an initialized CUDA context, the process mode is meant for CPU hosts.
+    Every worker uses SD_WORKER_THREADS torch threads, 0 splits the cores evenly between the workers.
+    If a worker dies the pool is not forked again: by then the main process runs other threads whose locks a child
+    could inherit, so the batch fails and later ones are rendered in the main process until it is restarted.
+    """
+    def __init__(self, processes: int, threads: int = 0):
+        global _generator
+        if settings.USE_GPU:
+            raise ValueError("ProcessImageGenerator: worker processes are only supported for CPU rendering")
+        self.processes = max(1, processes)
+        self.threads = threads if threads > 0 else max(1, (os.cpu_count() or 1) // self.processes)
+        self.preset_timings = {}
+        self.worker_images = {}
+        if _generator is None:
+            # compile in the workers, a compiled graph does not survive the fork
+            compile_, settings.SD_CPU_COMPILE = settings.SD_CPU_COMPILE, False
+            try:
+                _generator = SDImageGenerator()
+            finally:
+                settings.SD_CPU_COMPILE = compile_
+        self.pool = None
+        self._lock = threading.Lock()
+        self._start_pool()
+
+    def _start_pool(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("fork"),
+                                        initializer=_init_worker, initargs=(self.threads,))
+        # with fork all workers start on the first job, do it now before the main process starts more threads
+        self.pool.submit(_worker_ready).result()
+        logging.info(f"ProcessImageGenerator: {self.processes} worker process(es), "
+                     f"{self.threads} torch thread(s) each")
+
+    def generate(self, prompt: str, file_name: str):
+        self.generate_batch([prompt], [file_name])
+
+    def generate_batch(self, prompts: list, file_names: list) -> dict:
+        """Blocks until a worker process, or this one, has rendered the batch, returns the file names and metadata."""
+        pool = self.pool
+        try:
+            if pool is None:
+                result = _render(prompts, file_names)
+            else:
+                result = pool.submit(_render_job, prompts, file_names, settings.SD_PRESET).result()
+        except BrokenProcessPool:
+            with self._lock:
+                # several render threads see the same broken pool, only the first one shuts it down
+                if self.pool is pool:
+                    logging.error("ProcessImageGenerator: a worker process died, rendering in the main process "
+                                  "until restart")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.pool = None
+            raise
+        count, secs = self.preset_timings.get(result["preset"], (0, 0.0))
+        self.preset_timings[result["preset"]] = (count + len(file_names), secs + result["secs"])
+        self.worker_images[result["pid"]] = self.worker_images.get(result["pid"], 0) + len(file_names)
+        return result
+
+    def preset_stats(self) -> dict:
+        return {name: f"{count} images, {secs / count:.1f} secs/image"
+                for name, (count, secs) in self.preset_timings.items() if count}
+
+    def close(self):
+        global _generator
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        _generator = None
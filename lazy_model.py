@@ -0,0 +1,52 @@
+import gc
+import logging
+import sys
+import threading
+import time
+
+
+class LazyModel:
+    """
+    Builds a generator on first use instead of at startup, so instances that never generate images do not import
+    torch, diffusers or llama.cpp and do not load their weights. Attribute access is forwarded to the generator,
+    loading it if needed; use `instance` to look at it without loading.
+    """
+    def __init__(self, name: str, factory):
+        self.name = name
+        self.factory = factory
+        self.instance = None
+        self.load_secs = None
+        self.last_used = time.monotonic()
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self.instance is None:
+                logging.info(f"LazyModel: loading {self.name}...")
+                start = time.perf_counter()
+                self.instance = self.factory()
+                self.load_secs = time.perf_counter() - start
+                logging.info(f"LazyModel: {self.name} loaded in {self.load_secs:.1f} secs")
+            self.last_used = time.monotonic()
+            return self.instance
+
+    def unload(self):
+        """Drops the generator, a render already running keeps its own reference and finishes normally."""
+        with self._lock:
+            if self.instance is None:
+                return
+            close = getattr(self.instance, 'close', None)
+            if close is not None:
+                close()
+            self.instance = None
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logging.info(f"LazyModel: {self.name} unloaded")
+
+    def idle_secs(self) -> float:
+        return time.monotonic() - self.last_used
+
+    def __getattr__(self, item):
+        return getattr(self.get(), item)
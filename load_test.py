@@ -0,0 +1,191 @@
+"""
+End-to-end load test of NetworkMaker against the local mock gateway.
+
+Runs the real generate_images / create_ticket / check_statuses loops with stubbed prompt and image generators
+against mock_gateway.MockGateway and a throw-away database, then reports tickets/sec, gateway call latency
+percentiles, DB operations/sec and event-loop lag:
+
+    python load_test.py --duration 60 --images 500 --workers 4 --latency 0.05 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+from config import settings
+from main import NetworkMaker, setup_logging
+from mock_gateway import MockGateway
+
+
+class StubPromptGenerator:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+
+    def generate_prompts(self, tip: str = "", count: int = 1) -> list:
+        return [self.generate_prompt(tip) for _ in range(count)]
+
+    def generate_prompt(self, tip: str = "") -> dict:
+        time.sleep(self.delay)
+        num = random.randint(0, 10 ** 9)
+        return {
+            "Description": f"Load test image {num} in {tip} genre",
+            "Title": f"Load test {num}",
+            "SeriesName": "Load test",
+            "FileName": f"load_test_{num}",
+            "Tags": ["load", "test"],
+        }
+
+
+class StubImageGenerator:
+    def __init__(self, delay: float = 0.0, size: int = 4096):
+        self.delay = delay
+        self.size = size
+
+    def generate(self, prompt, file_name):
+        self.generate_batch([prompt], [file_name])
+
+    def generate_batch(self, prompts: list, file_names: list):
+        time.sleep(self.delay * len(file_names))
+        for file_name in file_names:
+            with open(file_name, "wb") as file:
+                file.write(os.urandom(self.size))
+
+
+def percentiles(values: list, points=(50, 95, 99)) -> dict:
+    if not values:
+        return {f"p{point}": None for point in points}
+    values = sorted(values)
+    return {f"p{point}": round(values[min(len(values) - 1, int(len(values) * point / 100))], 4) for point in points}
+
+
+async def monitor_loop_lag(samples: list, interval: float = 0.1):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+def instrument_gateway(maker: NetworkMaker, latencies: dict):
+    call = maker.client.call
+
+    async def timed_call(endpoint, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await call(endpoint, func, *args, **kwargs)
+        finally:
+            latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+
+    maker.client.call = timed_call
+
+
+async def count_tickets(maker: NetworkMaker) -> dict:
+    counts = {}
+    for name, func in (("cascade", maker.db.get_cascade_counts),
+                       ("sense", maker.db.get_sense_counts),
+                       ("nft", maker.db.get_nft_counts)):
+        counts[name] = {status: count for status, count in await func()}
+    return counts
+
+
+async def run_load_test(args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="network-maker-load-")
+    settings.DB_NAME = os.path.join(work_dir, "tickets.sqlite")
+    settings.BASE_IMG_PATH = os.path.join(work_dir, "images")
+    os.makedirs(settings.BASE_IMG_PATH)
+    settings.ENABLE_GENERATE_IMAGES = args.generate
+    settings.ENABLE_CREATE_TICKETS = True
+    settings.ENABLE_CHECK_STATUSES = True
+    settings.ENABLE_CASCADE = settings.ENABLE_SENSE = settings.ENABLE_NFT = True
+    settings.GENERATE_IMAGE_INTERVAL = 1
+    settings.CHECK_INTERVAL = 1
+    settings.CREATE_TICKET_WORKERS = args.workers
+    settings.CREATE_TICKET_RETRY_DELAY = 1
+    settings.CASCADE_TARGET_PER_HOUR = settings.SENSE_TARGET_PER_HOUR = settings.NFT_TARGET_PER_HOUR = args.rate
+    settings.CASCADE_MAX_IN_FLIGHT = settings.SENSE_MAX_IN_FLIGHT = settings.NFT_MAX_IN_FLIGHT = args.max_in_flight
+    settings.POLL_MIN_INTERVAL = max(1, int(args.step / 2))
+    settings.GATEWAY_RATE_LIMIT_PROCESS = settings.GATEWAY_RATE_LIMIT_RESULT = 0
+    settings.GATEWAY_BACKOFF_BASE = 0.05
+
+    gateway = MockGateway(args.latency, args.error_rate, args.step, args.failure_rate)
+    gateway_runner = await gateway.start(port=args.port)
+    maker = NetworkMaker("testnet", "load-test", gateway_url=f"http://127.0.0.1:{args.port}",
+                         img_generator=StubImageGenerator(args.render_delay),
+                         prompt_generator=StubPromptGenerator(args.prompt_delay))
+    latencies, loop_lag = {}, []
+    instrument_gateway(maker, latencies)
+
+    await maker.db.open()
+    await maker.db.initialize_db()
+    for _ in range(args.images):
+        prompt = maker.prompt_generator.generate_prompt("Load test")
+        file_path = os.path.join(settings.BASE_IMG_PATH, f"{prompt['FileName']}.jpg")
+        maker.img_generator.generate(prompt["Description"], file_path)
+        await maker.db.add_image(prompt["Description"], prompt["Title"], file_path)
+
+    reads, writes = maker.db.pool.reads, maker.db.pool.writes
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(coro) for coro in (
+        maker.generate_images(),
+        *[maker.create_ticket(n) for n in range(args.workers)],
+        maker.check_statuses(),
+        monitor_loop_lag(loop_lag),
+    )]
+    await asyncio.sleep(args.duration)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+
+    tickets = await count_tickets(maker)
+    total_tickets = sum(sum(counts.values()) for counts in tickets.values())
+    report = {
+        "duration (secs)": round(elapsed, 1),
+        "images": (await maker.db.number_of_images())[0],
+        "tickets": tickets,
+        "tickets/sec": round(total_tickets / elapsed, 3),
+        "gateway latency (secs)": {endpoint: {"calls": len(values), **percentiles(values)}
+                                   for endpoint, values in sorted(latencies.items())},
+        "gateway": maker.client.stats(),
+        "mock gateway": gateway.stats,
+        "image pipeline": {stage.name: stage.stats() for stage in maker.stages.values()},
+        "image backlog": {"mode": maker.generation_mode, "images": maker.image_backlog},
+        "db reads/sec": round((maker.db.pool.reads - reads) / elapsed, 1),
+        "db writes/sec": round((maker.db.pool.writes - writes) / elapsed, 1),
+        "event loop lag (secs)": {**percentiles(loop_lag), "max": round(max(loop_lag, default=0), 4)},
+        "work dir": work_dir,
+    }
+
+    await maker.client.close()
+    await maker.db.close()
+    await gateway_runner.cleanup()
+    maker.prompt_executor.shutdown(wait=False)
+    maker.render_executor.shutdown(wait=False)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Network Maker load test against a mock gateway')
+    parser.add_argument('--duration', type=float, default=60, help='Test duration, secs')
+    parser.add_argument('--images', type=int, default=200, help='Images inserted before the test starts')
+    parser.add_argument('--generate', action='store_true', help='Also run generate_images with the stubs')
+    parser.add_argument('--workers', type=int, default=2, help='Concurrent create_ticket workers')
+    parser.add_argument('--rate', type=float, default=3600, help='Target tickets per hour per ticket type')
+    parser.add_argument('--max-in-flight', type=int, default=1000, help='Max pending tickets per ticket type')
+    parser.add_argument('--port', type=int, default=8090, help='Mock gateway port')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean mock gateway response delay, secs')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of mock gateway requests failing')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of results ending up FAILED')
+    parser.add_argument('--step', type=float, default=5.0, help='Secs a result spends in every status')
+    parser.add_argument('--prompt-delay', type=float, default=0.0, help='Stub prompt generation time, secs')
+    parser.add_argument('--render-delay', type=float, default=0.05, help='Stub image rendering time, secs')
+    parser.add_argument('-l', '--logfile', type=str, required=False, help='Log file')
+    args = parser.parse_args()
+
+    setup_logging(args.logfile)
+    if not args.logfile:
+        logging.getLogger().setLevel(logging.WARNING)
+    print(json.dumps(asyncio.run(run_load_test(args)), indent=2))
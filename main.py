@@ -11,15 +11,21 @@ from enum import Enum
 import logging
 import random
 import signal
+import socket
 import sys
+import time
 
-from pastel_gateway_sdk import GatewayApiClientAsync, RequestResult, ResultRegistrationResult
+from pastel_gateway_sdk import RequestResult, ResultRegistrationResult
 from pastel_gateway_sdk.rest import ApiException
 
-from config import settings, biased_random, get_random_genre
-from db_manager import SQLiteDB
-from image_generator import SDImageGenerator
-from prompt_generator import LlamaPromptGenerator
+from config import settings, biased_random, get_random_genre, SD_PRESETS
+from db_manager import SQLiteDB, ConnectionPool
+from gateway_client import GatewayClient, CircuitOpenError
+from ticket_scheduler import TicketScheduler, TicketPlan
+from generation_pipeline import PipelineStage
+from prompt_index import MinHashIndex
+from image_index import SubmittedImageIndex, perceptual_hash, to_db, from_db
+from lazy_model import LazyModel
 from tools import execution_timer
 
 
@@ -42,60 +48,291 @@ def setup_logging(logfile=None):
     ])
 
 
+# what a node runs: generator - images and `images` rows, submitter - create_ticket, poller - check_statuses,
+# dashboard - the web UI; nodes with different roles share the DB and the image directory
+ROLES = ('generator', 'submitter', 'poller', 'dashboard')
+
+
+def create_image_generator():
+    # torch and diffusers are imported only when images are generated
+    if settings.SD_WORKER_PROCESSES > 0:
+        from image_workers import ProcessImageGenerator
+        return ProcessImageGenerator(settings.SD_WORKER_PROCESSES, settings.SD_WORKER_THREADS)
+    from image_generator import SDImageGenerator
+    return SDImageGenerator()
+
+
+def create_prompt_generator():
+    from prompt_generator import LlamaPromptGenerator
+    return LlamaPromptGenerator()
+
+
 class NetworkMaker:
-    def __init__(self, network: str, api_key: str):
+    def __init__(self, network: str, api_key: str, gateway_url: str = None,
+                 img_generator=None, prompt_generator=None, roles=None, db_pool: ConnectionPool = None,
+                 phash_index: SubmittedImageIndex = None):
+        started = time.perf_counter()
         self.network = network
+        self.roles = set(roles or ROLES)
         self.api_key = api_key
         self.client = None
         self.loop = asyncio.get_event_loop()
-        self.executor = ThreadPoolExecutor(max_workers=2)
-        self.db = SQLiteDB(settings.DB_NAME, network)
-        self.img_generator = SDImageGenerator()
-        self.prompt_generator = LlamaPromptGenerator()
-        self.client = GatewayApiClientAsync(network=self.network)
-        self.client.set_auth_api_key(self.api_key)
+        # the LLM and SD get their own threads, so prompt generation and rendering overlap
+        self.prompt_executor = ThreadPoolExecutor(max_workers=max(1, settings.PROMPT_WORKERS))
+        # in process mode every render thread only waits for its worker process
+        render_workers = settings.SD_WORKER_PROCESSES or settings.RENDER_WORKERS
+        self.render_executor = ThreadPoolExecutor(max_workers=max(1, render_workers))
+        self.db = SQLiteDB(settings.DB_NAME, network, db_pool)
+        # models are loaded on first use, an instance that only submits or checks tickets never loads them
+        workers_started = None
+        if img_generator is None and settings.SD_WORKER_PROCESSES > 0 and 'generator' in self.roles:
+            # except the render worker processes: they must fork before this process starts any other thread
+            # (aiosqlite, executors) that could hold a lock in the child, so they start now and are never unloaded
+            workers_started = time.perf_counter()
+            img_generator = create_image_generator()
+            workers_started = time.perf_counter() - workers_started
+        self.img_generator = img_generator or LazyModel("image generator", create_image_generator)
+        self.prompt_generator = prompt_generator or LazyModel("prompt generator", create_prompt_generator)
+        self.client = GatewayClient(self.network, self.api_key, custom_url=gateway_url)
+
+        self.status_semaphore = asyncio.Semaphore(settings.STATUS_CHECK_CONCURRENCY)
+        self.scheduler = self._create_scheduler()
+
+        self.prompt_queue = asyncio.Queue(maxsize=max(settings.PROMPT_QUEUE_SIZE, settings.SD_BATCH_SIZE))
+        self.image_queue = asyncio.Queue(maxsize=max(1, settings.IMAGE_QUEUE_SIZE))
+        self.stages = {
+            'prompt': PipelineStage("Prompt generation", settings.PROMPT_WORKERS, self.prompt_queue),
+            'render': PipelineStage("Image rendering", render_workers, self.image_queue),
+            'store': PipelineStage("DB insert", settings.STORE_WORKERS),
+        }
+        self.generation_mode = "interval"
+        self.image_backlog = 0
+        self.prompt_index = MinHashIndex()
+        # perceptual hashes of the images submitted to Sense or NFT, shared with the other networks of the process
+        self.phash_index = phash_index if phash_index is not None else SubmittedImageIndex(settings.PHASH_MAX_DISTANCE)
+        self.near_duplicate_images = 0
+        self.prompt_signatures_seen = 0
+        self.own_prompt_signatures = set()
 
+        # makers of the other networks of this process, their statistics are shown on this one's dashboard
+        self.peers = []
         self.statistics = {}
+        # the dashboard serves this snapshot, every new one replaces the event its readers wait on
+        self.stats_updated = None
+        self.stats_changed = asyncio.Event()
+        self.last_stats_refresh = 0.0
+        self.startup = {'NetworkMaker init': time.perf_counter() - started}
+        if workers_started is not None:
+            self.startup['image worker processes'] = workers_started
 
     @execution_timer
     async def generate_images(self):
+        """
+        Runs the generation pipeline: prompt producers -> image renderers -> DB inserters, connected by bounded
+        queues, so the LLM writes the next prompts while the current batch renders.
+        """
         logging.info(f"generate_images: Starting task...")
+        await self._refresh_prompt_index()
+        logging.info(f"generate_images: {len(self.prompt_index)} prompt signatures loaded")
+        await asyncio.gather(
+            *[self._produce_prompts(n) for n in range(self.stages['prompt'].workers)],
+            *[self._render_images(n) for n in range(self.stages['render'].workers)],
+            *[self._store_images(n) for n in range(self.stages['store'].workers)],
+        )
+
+    async def _produce_prompts(self, worker_num: int):
+        stage = self.stages['prompt']
         showed = False
         while True:
             if not settings.ENABLE_GENERATE_IMAGES:
                 if not showed:
                     logging.info("generate_images: Disabled")
                     showed = True
+                self._unload_idle_models()
                 await asyncio.sleep(settings.GENERATE_IMAGE_INTERVAL)
                 continue
             showed = False
+            await self._wait_for_backlog()
+            if not settings.ENABLE_GENERATE_IMAGES:
+                continue
 
             try:
-                prompt, file_name, file_path = await self.loop.run_in_executor(self.executor, self._generate_image)
-                logging.info(f"generate_images: Inserting new   image info into DB...")
-                tags = prompt.get("Tags", "")
-                keywords = ', '.join(tags)
-                await self.db.add_image(description=prompt["Description"], name=prompt.get("Title", file_name),
-                                        file_path=file_path, keywords=keywords,
-                                        series_name=prompt.get("SeriesName", ""))
-
-                logging.info(f"generate_images: DONE")
+                with stage.busy():
+                    prompts = await self.loop.run_in_executor(self.prompt_executor, self._generate_prompts)
             except Exception as error:
                 logging.exception(error)
-            await asyncio.sleep(settings.GENERATE_IMAGE_INTERVAL)
+                prompts = []
+            if not prompts:
+                logging.info("Prompt generation failed, wait for next iteration")
+                await asyncio.sleep(settings.GENERATE_IMAGE_INTERVAL)
+                continue
+            prompts = await self._drop_duplicate_prompts(prompts)
+            stage.items += len(prompts)
+            for prompt in prompts:
+                await self.prompt_queue.put(prompt)
+
+    def _unload_idle_models(self):
+        if settings.MODEL_UNLOAD_AFTER <= 0:
+            return
+        for model in (self.img_generator, self.prompt_generator):
+            if isinstance(model, LazyModel) and model.instance is not None \
+                    and model.idle_secs() > settings.MODEL_UNLOAD_AFTER:
+                model.unload()
+
+    @staticmethod
+    def _loaded(model):
+        """The generator behind a LazyModel if it is loaded, without loading it."""
+        return model.instance if isinstance(model, LazyModel) else model
 
-    def _generate_image(self) -> (dict | None, str | None, str | None):
-        logging.info(f"_generate_image: Starting thread...")
+    async def _image_backlog(self) -> int:
+        """
+        Images generated but not used yet by the ticket types that need them most, plus the ones in the pipeline.
+        """
+        backlogs = []
+        if settings.ENABLE_CASCADE:
+            backlogs.append(await self._cascade_backlog())
+        if settings.ENABLE_SENSE or settings.ENABLE_NFT:
+            backlogs.append(await self._sense_or_nft_backlog())
+        # nothing consumes images, so the backlog only grows
+        backlog = min(backlogs) if backlogs else max(await self._cascade_backlog(), await self._sense_or_nft_backlog())
+        return backlog + self.prompt_queue.qsize() + self.image_queue.qsize()
+
+    async def _wait_for_backlog(self):
+        """
+        Backpressure with hysteresis: generation pauses once the backlog reaches GENERATE_HIGH_WATERMARK and
+        resumes when it falls to GENERATE_LOW_WATERMARK; below the low mark images are rendered without the
+        GENERATE_IMAGE_INTERVAL pause. Both marks are re-read on every check, so they can be changed live.
+        """
+        while True:
+            high, low = settings.GENERATE_HIGH_WATERMARK, settings.GENERATE_LOW_WATERMARK
+            if high <= 0:
+                self.generation_mode = "interval"
+                return
+            self.image_backlog = await self._image_backlog()
+            if self.image_backlog >= high or (self.generation_mode == "paused" and self.image_backlog > low):
+                mode = "paused"
+            elif self.image_backlog < low:
+                mode = "full speed"
+            else:
+                mode = "interval"
+            if mode != self.generation_mode:
+                logging.info(f"generate_images: Backlog {self.image_backlog} images, "
+                             f"generation {self.generation_mode} -> {mode}")
+                self.generation_mode = mode
+            if mode != "paused" or not settings.ENABLE_GENERATE_IMAGES:
+                return
+            # not GENERATE_IMAGE_INTERVAL: set to 0 it would re-read the backlog in a busy loop
+            await asyncio.sleep(max(settings.BACKLOG_POLL_INTERVAL, 1))
+
+    async def _drop_duplicate_prompts(self, prompts: list) -> list:
+        """
+        Drops prompts too similar to an already rendered description, or to another prompt of the same batch,
+        before they cost a render and gateway fees. The producer then simply asks the LLM for new ones.
+        """
+        if settings.PROMPT_DEDUP_THRESHOLD <= 0:
+            return prompts
+        await self._refresh_prompt_index()
+        unique, signatures = [], []
+        for prompt in prompts:
+            duplicate, signature = self.prompt_index.check(prompt["Description"], settings.PROMPT_DEDUP_THRESHOLD)
+            if duplicate:
+                logging.info(f"generate_images: Near-duplicate prompt rejected - {prompt['Description'][:80]}")
+                continue
+            self.prompt_index.add(signature)
+            unique.append(prompt)
+            signatures.append(MinHashIndex.to_bytes(signature))
+        if signatures:
+            self.own_prompt_signatures.update(await self.db.add_prompt_signatures(signatures))
+        return unique
+
+    async def _refresh_prompt_index(self):
+        """Adds the signatures written by other generator nodes sharing the DB since the last refresh."""
+        for signature_id, signature in await self.db.read_prompt_signatures(self.prompt_signatures_seen):
+            self.prompt_signatures_seen = signature_id
+            if signature_id in self.own_prompt_signatures:
+                self.own_prompt_signatures.discard(signature_id)
+                continue
+            self.prompt_index.add(MinHashIndex.from_bytes(signature))
+
+    async def _render_images(self, worker_num: int):
+        stage = self.stages['render']
+        batch_size = max(1, settings.SD_BATCH_SIZE)
+        while True:
+            while not settings.ENABLE_GENERATE_IMAGES:
+                await asyncio.sleep(settings.GENERATE_IMAGE_INTERVAL)
+            # wait for one prompt, then take whatever else is ready up to the batch size
+            prompts = [await self.prompt_queue.get()]
+            while len(prompts) < batch_size and not self.prompt_queue.empty():
+                prompts.append(self.prompt_queue.get_nowait())
+
+            generated = []
+            for prompt in prompts:
+                for _ in range(max(1, settings.SD_IMAGES_PER_PROMPT)):
+                    file_name, file_path = self._image_file_path(prompt)
+                    generated.append((prompt, file_name, file_path))
+            try:
+                with stage.busy():
+                    await self.loop.run_in_executor(self.render_executor, self._generate_image_batch,
+                                                    prompts, generated)
+            except Exception as error:
+                logging.exception(error)
+                for _, _, file_path in generated:
+                    self._remove_image_file(file_path)
+                generated = []
+            stage.items += len(generated)
+            for image in generated:
+                await self.image_queue.put(image)
+            if self.generation_mode != "full speed":
+                await asyncio.sleep(settings.GENERATE_IMAGE_INTERVAL)
+
+    async def _store_images(self, worker_num: int):
+        stage = self.stages['store']
+        while True:
+            prompt, file_name, file_path = await self.image_queue.get()
+            try:
+                with stage.busy():
+                    logging.info(f"generate_images: Inserting new image info into DB...")
+                    tags = prompt.get("Tags", "")
+                    keywords = ', '.join(tags)
+                    phash = await self.loop.run_in_executor(None, perceptual_hash, file_path)
+                    await self.db.add_image(description=prompt["Description"], name=prompt.get("Title", file_name),
+                                            file_path=file_path, keywords=keywords,
+                                            series_name=prompt.get("SeriesName", ""), phash=to_db(phash))
+                stage.items += 1
+            except Exception as error:
+                logging.exception(error)
+
+    def _generate_image_batch(self, prompts: list, generated: list):
+        """
+        Renders the prompts in one pipeline call, `generated` holds a (prompt, file_name, file_path) tuple
+        per image.
+        """
+        logging.info(f"Generate {len(generated)} image(s) for {len(prompts)} prompt(s)")
+        self.img_generator.generate_batch([prompt["Description"] for prompt in prompts],
+                                          [file_path for _, _, file_path in generated])
+        logging.info(f"generate_images: DONE - {', '.join(file_name for _, file_name, _ in generated)} generated")
+
+    def _generate_prompts(self) -> list:
         genre = get_random_genre()
-        prompt: dict = self.prompt_generator.generate_prompt(genre)
-        logging.info(f"Prompt: {prompt}")
-        if (prompt is None
-                or "Description" not in prompt
-                or not prompt["Description"]
-                or not isinstance(prompt["Description"], str)
-                or len(prompt["Description"]) == 0):
-            logging.info("Prompt generation failed, wait for next iteration")
-            return None, None, None
+        batch_size = max(1, settings.PROMPT_BATCH_SIZE)
+        if batch_size > 1:
+            prompts: list = self.prompt_generator.generate_prompts(genre, batch_size)
+        else:
+            prompts = [self.prompt_generator.generate_prompt(genre)]
+        valid = []
+        for prompt in prompts:
+            logging.info(f"Prompt: {prompt}")
+            if (not isinstance(prompt, dict)
+                    or "Description" not in prompt
+                    or not prompt["Description"]
+                    or not isinstance(prompt["Description"], str)
+                    or len(prompt["Description"]) == 0):
+                logging.info("Prompt generation failed")
+                continue
+            valid.append(prompt)
+        return valid
+
+    def _image_file_path(self, prompt: dict) -> (str, str):
         if "FileName" not in prompt:
             logging.info("No file names in prompt, generating random file name")
             file_name: str = f"{random.randint(100000, 999999)}.jpg"
@@ -106,59 +343,68 @@ class NetworkMaker:
                 file_name = f"{file_name}.jpg"
         file_path: str = os.path.join(settings.BASE_IMG_PATH, file_name)
         file_path = self._check_image_path(file_path)
-        logging.info(f"Generate image {file_path}")
-        self.img_generator.generate(prompt["Description"], file_path)
-        logging.info(f"generate_images: DONE - {file_name} generated")
-        return prompt, file_name, file_path
+        return file_name, file_path
 
     @staticmethod
     def _check_image_path(filepath):
+        """
+        Reserves a free file name by creating an empty file with O_EXCL, which is atomic even between generator
+        nodes sharing the image directory, and between images of one batch that are not rendered yet.
+        """
         base = os.path.splitext(filepath)[0]
         ext = os.path.splitext(filepath)[1]
         while True:
             rand_num = random.randint(0, 9999)
             new_filename = f"{base}_{rand_num}{ext}"
-            if not os.path.exists(new_filename):
+            try:
+                os.close(os.open(new_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
                 return new_filename
+            except FileExistsError:
+                continue
+
+    @staticmethod
+    def _remove_image_file(file_path: str):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
 
-    async def create_ticket(self):
-        logging.info(f"create_ticket: Starting task...")
+    async def create_ticket(self, worker_num: int = 0):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{self.network}:{worker_num}"
+        logging.info(f"create_ticket: Starting task {worker_id}...")
         while True:
             if not settings.ENABLE_CREATE_TICKETS:
                 logging.info("create_ticket: Disabled")
                 await asyncio.sleep(settings.CREATE_TICKET_INTERVAL)
                 continue
-            if not (settings.ENABLE_CASCADE or settings.ENABLE_SENSE or settings.ENABLE_NFT or settings.ENABLE_COLLECTIONS):
+            if not (settings.ENABLE_CASCADE or settings.ENABLE_SENSE or settings.ENABLE_NFT):
                 logging.info("create_ticket: No ticket types enabled")
                 await asyncio.sleep(settings.CREATE_TICKET_INTERVAL)
                 continue
             while not self.db.initialized:
                 logging.info("create_ticket: DB not initialized")
                 await asyncio.sleep(5)
+            if self.client.breaker.is_open:
+                logging.info(f"create_ticket: Gateway circuit breaker is open, "
+                             f"pausing for {self.client.breaker.retry_in():.0f} secs")
+                await asyncio.sleep(self.client.breaker.retry_in())
+                continue
 
-            while True:
-                selected_type: TicketType = random.choice(list(TicketType))
-                if selected_type == TicketType.CASCADE and settings.ENABLE_CASCADE:
-                    break
-                elif selected_type == TicketType.SENSE and settings.ENABLE_SENSE:
-                    break
-                elif selected_type == TicketType.NFT and settings.ENABLE_NFT:
-                    break
-                elif selected_type == TicketType.COLLECTION and settings.ENABLE_COLLECTIONS:
-                    break
+            selected_type, wait = await self.scheduler.next_ticket()
+            if selected_type is None:
+                await asyncio.sleep(wait)
+                continue
             logging.info(f"create_ticket: Create {selected_type.name} ticket on {self.network} network")
+            registered = 0
             try:
-                ok = False
                 if selected_type == TicketType.CASCADE:
-                    ok = await self._register_cascade_ticket()
+                    registered = await self._register_cascade_ticket(worker_id)
                 elif selected_type == TicketType.SENSE:
-                    ok = await self._register_sense_ticket()
+                    registered = await self._register_sense_ticket(worker_id)
                 elif selected_type == TicketType.NFT:
-                    ok = await self._register_nft_ticket()
-                elif selected_type == TicketType.COLLECTION:
-                    ok = await self._register_collection_ticket()
+                    registered = await self._register_nft_ticket(worker_id)
 
-                if ok:
+                if registered:
                     logging.info(f"create_ticket: DONE")
                 else:
                     logging.info(f"create_ticket: FAILED, wait for next iteration")
@@ -166,62 +412,207 @@ class NetworkMaker:
                 logging.exception(error)
             except Exception as error:
                 logging.exception(error)
-            await asyncio.sleep(settings.CREATE_TICKET_INTERVAL)
+            finally:
+                self.scheduler.done(selected_type, registered)
+            if not registered:
+                # the credit was refunded, do not retry a failing type in a tight loop
+                await asyncio.sleep(settings.CREATE_TICKET_RETRY_DELAY)
 
-    async def _register_cascade_ticket(self) -> bool:
-        image_rec = await self.db.find_image_for_cascade()
-        if not image_rec:
-            logging.info("No images to process for Cascade, wait for next iteration")
-            return False
+    def _create_scheduler(self) -> TicketScheduler:
+        # settings are read on every call, so targets and limits can be changed at runtime
+        return TicketScheduler([
+            TicketPlan(TicketType.CASCADE, "Cascade",
+                       lambda: settings.ENABLE_CASCADE,
+                       lambda: settings.CASCADE_TARGET_PER_HOUR,
+                       lambda: settings.CASCADE_MAX_IN_FLIGHT,
+                       self.db.count_cascade_in_flight,
+                       self._cascade_backlog),
+            TicketPlan(TicketType.SENSE, "Sense",
+                       lambda: settings.ENABLE_SENSE,
+                       lambda: settings.SENSE_TARGET_PER_HOUR,
+                       lambda: settings.SENSE_MAX_IN_FLIGHT,
+                       self.db.count_sense_in_flight,
+                       self._sense_or_nft_backlog),
+            TicketPlan(TicketType.NFT, "NFT",
+                       lambda: settings.ENABLE_NFT,
+                       lambda: settings.NFT_TARGET_PER_HOUR,
+                       lambda: settings.NFT_MAX_IN_FLIGHT,
+                       self.db.count_nft_in_flight,
+                       self._sense_or_nft_backlog),
+        ], max_burst=settings.SCHEDULER_MAX_BURST)
+
+    async def _cascade_backlog(self) -> int:
+        return (await self.db.number_of_images_for_cascade())[0]
+
+    async def _sense_or_nft_backlog(self) -> int:
+        return (await self.db.number_of_images_for_sense_or_nft())[0]
+
+    @staticmethod
+    async def _register_claimed(type_name: str, worker_id: str, batch_size: int,
+                                func_claim, func_release, func_submit, func_filter=None, func_submitted=None,
+                                func_not_submitted=None) -> int:
+        """
+        Claims, submits and records a batch of images, returns the number of images registered.
+        `func_filter` may drop claimed images before submission, `func_submitted` is told about submitted ones and
+        `func_not_submitted` gets the ids of the claimed images when the submission failed.
+        """
+        image_recs = await func_claim(worker_id, max(1, batch_size))
+        if not image_recs:
+            logging.info(f"No images to process for {type_name}, wait for next iteration")
+            return 0
+        img_ids = [image_rec['id'] for image_rec in image_recs]
+        try:
+            if func_filter is not None:
+                image_recs = await func_filter(image_recs)
+                if not image_recs:
+                    logging.info(f"Only near-duplicate images claimed for {type_name}, wait for next iteration")
+                    return 0
+            ok = await func_submit(image_recs, worker_id)
+        except BaseException:
+            if func_not_submitted is not None:
+                func_not_submitted(img_ids)
+            # return the images to the queue right away instead of waiting for the lease to expire
+            await func_release(img_ids, worker_id)
+            raise
+        if not ok:
+            if func_not_submitted is not None:
+                func_not_submitted(img_ids)
+            await func_release(img_ids, worker_id)
+            return 0
+        if func_submitted is not None:
+            func_submitted(image_recs)
+        return len(image_recs)
+
+    async def _refresh_phash_index(self):
+        """Adds the images submitted to Sense or NFT by any network or node sharing the DB since the last refresh."""
+        index = self.phash_index
+        start, first = time.perf_counter(), index.seen == 0
+        for log_id, img_id, phash in await self.db.read_submitted_phashes(index.seen):
+            index.seen = log_id
+            index.add_submitted(from_db(phash), img_id)
+        if first and index.seen:
+            logging.info(f"Perceptual hash index of {len(index)} images built in "
+                         f"{time.perf_counter() - start:.2f} secs")
+
+    async def _skip_near_duplicates(self, image_recs: list) -> list:
+        """
+        Drops images whose perceptual hash is within PHASH_MAX_DISTANCE bits of an image already submitted to
+        Sense or NFT, or being submitted right now, and marks them so they are never claimed for Sense/NFT again.
+        They stay available for Cascade. The kept images are reserved until their submission is recorded or fails.
+        """
+        if settings.PHASH_MAX_DISTANCE < 0:
+            return image_recs
+        kept, duplicates = [], []
+        async with self.phash_index.lock:
+            await self._refresh_phash_index()
+            for image_rec in image_recs:
+                phash = from_db(image_rec['phash'])
+                if phash is None:
+                    kept.append(image_rec)
+                    continue
+                matches = self.phash_index.find(phash, image_rec['id'])
+                if matches:
+                    duplicate_of = min(matches)[1]
+                    logging.info(f"Image {image_rec['id']} is a near-duplicate of image {duplicate_of}, "
+                                 f"skipped for Sense/NFT")
+                    duplicates.append((image_rec['id'], duplicate_of))
+                else:
+                    kept.append(image_rec)
+                    self.phash_index.reserve(phash, image_rec['id'])
+        if duplicates:
+            await self.db.mark_near_duplicates(duplicates)
+            self.near_duplicate_images += len(duplicates)
+        return kept
+
+    def _index_submitted_images(self, image_recs: list):
+        # the submission is recorded, the DB log has the hashes for everyone else
+        self.phash_index.confirm([image_rec['id'] for image_rec in image_recs])
+
+    def _release_phash_reservations(self, img_ids: list):
+        self.phash_index.release(img_ids)
+
+    @staticmethod
+    def _match_results(output: RequestResult, image_recs: list) -> list:
+        """
+        Pairs every submitted image with its ResultRegistrationResult, by file name first and by order for the rest.
+        Returns (img_id, res_status, req_id, res_id, reg_txid, act_txid) records, images without a result get
+        empty result fields like before.
+        """
+        results: list[ResultRegistrationResult] = list(output.results or [])
+        matched = {}
+        for image_rec in image_recs:
+            file_name = os.path.basename(image_rec['file_path'])
+            for result in results:
+                if result.file_name and result.file_name == file_name:
+                    matched[image_rec['id']] = result
+                    results.remove(result)
+                    break
+        for image_rec in image_recs:
+            if image_rec['id'] not in matched and results:
+                matched[image_rec['id']] = results.pop(0)
+
+        records = []
+        for image_rec in image_recs:
+            res_id = reg_txid = act_txid = res_status = ""
+            result = matched.get(image_rec['id'])
+            if result:
+                res_id, res_status = result.result_id, result.result_status.value
+                reg_txid, act_txid = result.registration_ticket_txid, result.activation_ticket_txid
+            records.append((image_rec['id'], res_status, output.request_id, res_id, reg_txid, act_txid))
+        return records
+
+    async def _register_cascade_ticket(self, worker_id: str) -> int:
+        return await self._register_claimed("Cascade", worker_id, settings.CASCADE_BATCH_SIZE,
+                                            self.db.claim_images_for_cascade,
+                                            self.db.release_cascade_claim, self._submit_cascade_ticket)
+
+    async def _submit_cascade_ticket(self, image_recs: list, worker_id: str) -> bool:
         make_publicly_accessible = random.choice([True, False])
-        file_list, image_rec_id = [image_rec['file_path']], image_rec['id']
+        file_list = [image_rec['file_path'] for image_rec in image_recs]
         output: RequestResult = await self.client.cascade_api.cascade_process_request(file_list,
                                                                                       make_publicly_accessible)
-        res_id = reg_txid = act_txid = res_status = ""
         if output:
-            if output.results and len(output.results) > 0:
-                result: ResultRegistrationResult = output.results[0]
-                res_id, res_status = result.result_id, result.result_status.value
-                reg_txid, act_txid = result.registration_ticket_txid, result.activation_ticket_txid
-            await self.db.add_cascade(image_rec_id, res_status, output.request_id, res_id, reg_txid, act_txid,
-                                      make_publicly_accessible)
-            logging.info(f"Cascade ticket registration started. Request ID {output.request_id}. "
-                         f"Request status: {output.request_status}")
+            await self.db.add_cascade_batch(self._match_results(output, image_recs), make_publicly_accessible,
+                                            worker_id=worker_id)
+            logging.info(f"Cascade ticket registration started for {len(file_list)} file(s). "
+                         f"Request ID {output.request_id}. Request status: {output.request_status}")
             return True
         else:
             logging.info(f"Failed to register Cascade ticket")
             return False
 
-    async def _register_sense_ticket(self) -> bool:
-        image_rec = await self.db.find_image_for_sense_or_nft()
-        if not image_rec:
-            logging.info("No images to process for Sense, wait for next iteration")
-            return False
+    async def _register_sense_ticket(self, worker_id: str) -> int:
+        return await self._register_claimed("Sense", worker_id, settings.SENSE_BATCH_SIZE,
+                                            self.db.claim_images_for_sense_or_nft,
+                                            self.db.release_sense_or_nft_claim, self._submit_sense_ticket,
+                                            self._skip_near_duplicates, self._index_submitted_images,
+                                            self._release_phash_reservations)
+
+    async def _submit_sense_ticket(self, image_recs: list, worker_id: str) -> bool:
         collection_act_txid, open_api_group_id = "", ""
-        file_list, image_rec_id = [image_rec['file_path']], image_rec['id']
+        file_list = [image_rec['file_path'] for image_rec in image_recs]
         output: RequestResult = await self.client.sense_api.sense_process_request(file_list, collection_act_txid,
                                                                                   open_api_group_id)
-        res_id = reg_txid = act_txid = res_status = ""
         if output:
-            if output.results and len(output.results) > 0:
-                result: ResultRegistrationResult = output.results[0]
-                res_id, res_status = result.result_id, result.result_status.value
-                reg_txid, act_txid = result.registration_ticket_txid, result.activation_ticket_txid
-            await self.db.add_sense(image_rec_id, res_status, output.request_id, res_id, reg_txid, act_txid,
-                                    collection_act_txid, open_api_group_id)
-            logging.info(f"Sense ticket registration started. Request ID {output.request_id}. "
-                         f"Request status: {output.request_status}")
+            await self.db.add_sense_batch(self._match_results(output, image_recs),
+                                          collection_act_txid, open_api_group_id, worker_id=worker_id)
+            logging.info(f"Sense ticket registration started for {len(file_list)} file(s). "
+                         f"Request ID {output.request_id}. Request status: {output.request_status}")
             return True
         else:
             logging.info(f"Failed to register Sense ticket")
             return False
 
-    async def _register_nft_ticket(self) -> bool:
-        image_rec = await self.db.find_image_for_sense_or_nft()
-        if not image_rec:
-            logging.info("No images to process for NFT, wait for next iteration")
-            return False
+    async def _register_nft_ticket(self, worker_id: str) -> int:
+        # nft_process_request takes a single file, so NFT tickets are never batched
+        return await self._register_claimed("NFT", worker_id, 1,
+                                            self.db.claim_images_for_sense_or_nft,
+                                            self.db.release_sense_or_nft_claim, self._submit_nft_ticket,
+                                            self._skip_near_duplicates, self._index_submitted_images,
+                                            self._release_phash_reservations)
 
+    async def _submit_nft_ticket(self, image_recs: list, worker_id: str) -> bool:
+        image_rec = image_recs[0]
         name = image_rec['name']
         (base, ext) = os.path.splitext(name)
         while ext:
@@ -260,7 +651,7 @@ class NetworkMaker:
                                   issued_copies=nft_details_payload["issued_copies"],
                                   green=nft_details_payload["green"], royalty=nft_details_payload["royalty"],
                                   collection_act_txid=collection_act_txid, open_api_group_id=open_api_group_id,
-                                  make_publicly_accessible=make_publicly_accessible)
+                                  make_publicly_accessible=make_publicly_accessible, worker_id=worker_id)
             logging.info(f"NFT ticket registration started. Request ID {output.request_id}. "
                          f"Request status: {output.request_status}")
             return True
@@ -281,6 +672,12 @@ class NetworkMaker:
                 logging.info("create_ticket: DB not initialized")
                 await asyncio.sleep(5)
 
+            if self.client.breaker.is_open:
+                logging.info(f"check_statuses: Gateway circuit breaker is open, "
+                             f"pausing for {self.client.breaker.retry_in():.0f} secs")
+                await asyncio.sleep(self.client.breaker.retry_in())
+                continue
+
             logging.info(f"check_statuses: Check ticket registration statuses")
             try:
                 await self.update_statuses()
@@ -290,38 +687,88 @@ class NetworkMaker:
                 logging.info(f"check_statuses: DONE")
             except Exception as error:
                 logging.exception(error)
-            await asyncio.sleep(settings.CHECK_INTERVAL)
+            await asyncio.sleep(await self._seconds_until_next_check())
+
+    async def _seconds_until_next_check(self) -> float:
+        # wake up as soon as the earliest ticket is due, but at least once per CHECK_INTERVAL
+        try:
+            next_due = await self.db.next_check_due()
+        except Exception as error:
+            logging.exception(error)
+            next_due = None
+        if next_due is None:
+            return settings.CHECK_INTERVAL
+        return min(settings.CHECK_INTERVAL, max(1.0, next_due - time.time()))
 
     async def update_statuses(self):
-        await self._check_ticket_status(self.db.get_cascade_pending,
-                                        self.client.cascade_api.cascade_get_result,
-                                        self.db.update_cascade_status)
-        await self._check_ticket_status(self.db.get_sense_pending,
-                                        self.client.sense_api.sense_get_result,
-                                        self.db.update_sense_status)
-        await self._check_ticket_status(self.db.get_nft_pending,
-                                        self.client.nft_api.nft_get_result,
-                                        self.db.update_nft_status)
-        # await self._check_ticket_status(self.db.get_collections_pending,
-        #                                 self.client.collection_api.collection_get_result,
-        #                                 self.db.update_collection_status)
+        await asyncio.gather(
+            self._check_ticket_status("Cascade", self.db.get_cascade_pending,
+                                      self.client.cascade_api.cascade_get_result,
+                                      self.db.update_cascade_statuses),
+            self._check_ticket_status("Sense", self.db.get_sense_pending,
+                                      self.client.sense_api.sense_get_result,
+                                      self.db.update_sense_statuses),
+            self._check_ticket_status("NFT", self.db.get_nft_pending,
+                                      self.client.nft_api.nft_get_result,
+                                      self.db.update_nft_statuses),
+            # self._check_ticket_status("Collection", self.db.get_collections_pending,
+            #                           self.client.collection_api.collection_get_result,
+            #                           self.db.update_collections_statuses),
+        )
 
     async def collect_stats(self):
-        all_images = await self.db.read_all_images()
-        images_for_cascade = await self.db.number_of_images_for_cascade()
-        images_for_sense_or_nft = await self.db.number_of_images_for_sense_or_nft()
-
-        logging.info("check_statuses: Total images: {}".format(len(all_images)))
-        self.statistics['Total images'] = len(all_images)
-        self.statistics['Images for Cascade'] = images_for_cascade[0]
-        self.statistics['Images for Sense or NFT'] = images_for_sense_or_nft[0]
-        await self.log_ticket_counts(self.db.get_cascade_counts, "Cascade")
-        await self.log_ticket_counts(self.db.get_sense_counts, "Sense")
-        await self.log_ticket_counts(self.db.get_nft_counts, "NFT")
-        await self.log_ticket_counts(self.db.get_collections_counts, "Collections")
-
-    async def log_ticket_counts(self, get_counts_function, ticket_type):
-        nums = await get_counts_function()
+        # counters kept by DB triggers, one small read however many images and tickets there are
+        counters = await self.db.read_counters()
+        images = counters[self.db.images_table_name]
+
+        logging.info("check_statuses: Total images: {}".format(images.get('total', 0)))
+        self.statistics['Total images'] = images.get('total', 0)
+        self.statistics['Images for Cascade'] = images.get('for_cascade', 0)
+        self.statistics['Images for Sense or NFT'] = images.get('for_sense_or_nft', 0)
+        self.log_ticket_counts(counters[self.db.cascade_table_name], "Cascade")
+        self.log_ticket_counts(counters[self.db.sense_table_name], "Sense")
+        self.log_ticket_counts(counters[self.db.nft_table_name], "NFT")
+        self.log_ticket_counts(counters[self.db.collection_table_name], "Collections")
+        self.statistics['Gateway'] = self.client.stats()
+        self.statistics['Ticket scheduler'] = self.scheduler.stats()
+        self.statistics['Duplicate images'] = {
+            'indexed': len(self.phash_index),
+            'being submitted': len(self.phash_index.reserved),
+            'skipped for Sense/NFT': self.near_duplicate_images,
+        }
+        self.statistics['Startup'] = {phase: f"{secs:.2f} secs" for phase, secs in self.startup.items()}
+        if 'generator' in self.roles:
+            self._collect_generator_stats()
+        self._publish_stats()
+
+    def _publish_stats(self):
+        self.stats_updated = time.time()
+        changed, self.stats_changed = self.stats_changed, asyncio.Event()
+        changed.set()
+
+    def _collect_generator_stats(self):
+        # the pipeline and the models are shared by all networks of the process, only the generating maker shows them
+        self.statistics['Image pipeline'] = {stage.name: stage.stats() for stage in self.stages.values()}
+        if settings.GENERATE_HIGH_WATERMARK > 0:
+            self.statistics['Image pipeline']['Backpressure'] = (
+                f"{self.generation_mode}, backlog {self.image_backlog} "
+                f"(low {settings.GENERATE_LOW_WATERMARK}, high {settings.GENERATE_HIGH_WATERMARK})")
+        self.statistics['Duplicate prompts'] = self.prompt_index.stats()
+        prompt_generator, img_generator = self._loaded(self.prompt_generator), self._loaded(self.img_generator)
+        if hasattr(prompt_generator, 'stats'):
+            self.statistics['Prompt generator'] = prompt_generator.stats()
+        if hasattr(img_generator, 'preset_stats'):
+            self.statistics['Image presets'] = img_generator.preset_stats()
+        if hasattr(img_generator, 'worker_images'):
+            self.statistics['Image workers'] = {f"pid {pid}": f"{count} images"
+                                                for pid, count in img_generator.worker_images.items()}
+        for model in (self.img_generator, self.prompt_generator):
+            if isinstance(model, LazyModel):
+                self.statistics['Startup'][model.name] = (
+                    f"loaded in {model.load_secs:.1f} secs" if model.instance is not None else "not loaded")
+
+    def log_ticket_counts(self, counts: dict, ticket_type):
+        nums = [(status or None, count) for status, count in counts.items() if count > 0]
         total = sum(count for status, count in nums)
         msg = f"\t{ticket_type} tickets: {total};"
         stats = {'total': total}
@@ -331,75 +778,205 @@ class NetworkMaker:
         logging.info(msg)
         self.statistics[ticket_type] = stats
 
-    @staticmethod
-    async def _check_ticket_status(func_get_pending, func_get_result, func_update_status):
+    async def _check_ticket_status(self, type_name: str, func_get_pending, func_get_result, func_update_statuses):
         pending = await func_get_pending()
         if not pending:
             return
-        for ticket in pending:
+        type_semaphore = asyncio.Semaphore(settings.STATUS_CHECK_CONCURRENCY_PER_TYPE)
+
+        async def check(ticket):
+            res_id = ticket['res_id']
+            # a poll without a status change backs the ticket off, see db_manager.schedule_next_check
+            unchanged = (ticket['id'], ticket['status'], ticket['reg_txid'], ticket['act_txid'],
+                         ticket['check_count'] + 1)
             try:
-                res_id = ticket['res_id']
-                result = await func_get_result(res_id)
-                if result:
-                    res_status = result.result_status.value
-                    if res_status != ticket['status']:
-                        reg_txid = result.registration_ticket_txid
-                        act_txid = result.activation_ticket_txid
-                        await func_update_status(ticket['id'], res_status, reg_txid, act_txid)
-                        logging.info(f"Cascade ticket status checked. Result ID {res_id}. "
-                                     f"Request status: {res_status}")
-                else:
-                    logging.info(f"Failed to get Cascade ticket status. Result ID {res_id}.")
+                async with type_semaphore, self.status_semaphore:
+                    result = await func_get_result(res_id)
+                if not result:
+                    logging.info(f"Failed to get {type_name} ticket status. Result ID {res_id}.")
+                    return unchanged
+                res_status = result.result_status.value
+                if res_status == ticket['status']:
+                    return unchanged
+                logging.info(f"{type_name} ticket status checked. Result ID {res_id}. Request status: {res_status}")
+                return ticket['id'], res_status, result.registration_ticket_txid, result.activation_ticket_txid, 0
+            except CircuitOpenError:
+                # the gateway is down, not the ticket - keep its schedule as is
+                return None
             except ApiException as error:
                 logging.exception(error)
             except Exception as error:
                 logging.exception(error)
+            return unchanged
+
+        results = await asyncio.gather(*[check(ticket) for ticket in pending])
+        updates = [update for update in results if update is not None]
+        batch_size = max(1, settings.STATUS_UPDATE_BATCH_SIZE)
+        for i in range(0, len(updates), batch_size):
+            await func_update_statuses(updates[i:i + batch_size])
 
     async def run(self):
+        started = time.perf_counter()
+        await self.db.open()
         await self.db.initialize_db()
+        self.startup['DB open and migrations'] = time.perf_counter() - started
+        runner = None
+        if 'dashboard' in self.roles:
+            runner = await self._start_dashboard()
+            self.startup['web server'] = time.perf_counter() - started - self.startup['DB open and migrations']
+        logging.info(f"Startup: roles {', '.join(sorted(self.roles))}; " +
+                     ", ".join(f"{phase} {secs:.2f} secs" for phase, secs in self.startup.items()))
+
+        tasks = []
+        if 'generator' in self.roles:
+            tasks.append(self.generate_images())
+        if 'submitter' in self.roles:
+            tasks.extend(self.create_ticket(n) for n in range(max(1, settings.CREATE_TICKET_WORKERS)))
+        if 'poller' in self.roles:
+            tasks.append(self.check_statuses())
+        if 'dashboard' in self.roles:
+            tasks.append(self.refresh_statistics())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            if runner is not None:
+                await runner.cleanup()
+            await self.client.close()
+            await self.db.close()
+            if 'generator' in self.roles:
+                for model in (self.img_generator, self.prompt_generator):
+                    if isinstance(model, LazyModel):
+                        model.unload()
+                    elif hasattr(model, 'close'):
+                        model.close()
+            logging.info("Exiting...")
+
+    async def _start_dashboard(self) -> web.AppRunner:
         app = web.Application()
         aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(os.path.join(BASE_DIR, 'web')))
         app.add_routes([web.get('/', self.show_statistics),
+                        web.get('/statistics_events', self.stream_statistics),
+                        web.post('/refresh_statistics', self.refresh_statistics_now),
                         web.post('/toggle_create_images', self.toggle_create_images),
                         web.post('/toggle_create_tickets', self.toggle_create_tickets),
                         web.post('/toggle_enable_cascade', self.toggle_enable_cascade),
                         web.post('/toggle_enable_sense', self.toggle_enable_sense),
                         web.post('/toggle_enable_nft', self.toggle_enable_nft),
-                        web.post('/toggle_enable_collections', self.toggle_enable_collections)])
+                        web.post('/toggle_enable_collections', self.toggle_enable_collections),
+                        web.post('/set_preset', self.set_preset),
+                        web.post('/set_watermarks', self.set_watermarks)])
         runner = web.AppRunner(app)
         await runner.setup()
-        site = web.TCPSite(runner, port=8080)
+        site = web.TCPSite(runner, port=settings.WEB_PORT)
         await site.start()
+        return runner
 
-        # threading.Thread(target=web.run_app, args=(app,), kwargs={'port': 8080}, daemon=True).start()
-        await asyncio.gather(
-            self.generate_images(),
-            self.create_ticket(),
-            self.check_statuses()
-        )
-        await self.client.close()
-        logging.info("Exiting...")
+    async def refresh_statistics(self):
+        """
+        Keeps the statistics snapshots of all networks of the process fresh. Page loads and the event stream only
+        read the snapshots, so the number of open dashboards does not change the DB or gateway load.
+        """
+        logging.info(f"refresh_statistics: Starting task...")
+        while True:
+            for maker in [self, *self.peers]:
+                if not maker.db.initialized:
+                    continue
+                try:
+                    await maker.collect_stats()
+                except Exception as error:
+                    logging.exception(error)
+            await asyncio.sleep(settings.STATS_INTERVAL)
+
+    @staticmethod
+    def _stats_time(maker) -> str:
+        if maker.stats_updated is None:
+            return "-"
+        return time.strftime("%H:%M:%S", time.localtime(maker.stats_updated))
 
     async def show_statistics(self, request):
-        await self.update_statuses()
-        await self.collect_stats()
+        makers = [self, *self.peers]
+        for maker in makers:
+            if maker.stats_updated is None and maker.db.initialized:
+                await maker.collect_stats()
         try:
             response = aiohttp_jinja2.render_template('statistics.html', request,
                                                       {
-                                                          'statistics': self.statistics,
-                                                          'network': self.network,
+                                                          'networks': [(maker.network, maker.statistics,
+                                                                        self._stats_time(maker))
+                                                                       for maker in makers],
+                                                          'network': ", ".join(maker.network for maker in makers),
                                                           'create_images': settings.ENABLE_GENERATE_IMAGES,
                                                           'create_tickets': settings.ENABLE_CREATE_TICKETS,
                                                           'enable_cascade': settings.ENABLE_CASCADE,
                                                           'enable_sense': settings.ENABLE_SENSE,
                                                           'enable_nft': settings.ENABLE_NFT,
                                                           'enable_collections': settings.ENABLE_COLLECTIONS,
+                                                          'presets': SD_PRESETS,
+                                                          'preset': settings.SD_PRESET,
+                                                          'low_watermark': settings.GENERATE_LOW_WATERMARK,
+                                                          'high_watermark': settings.GENERATE_HIGH_WATERMARK,
                                                       })
         except Exception as error:
             logging.exception(error)
             response = web.Response(text="Error")
         return response
 
+    async def stream_statistics(self, request):
+        """Server-sent events: the card of a network is pushed again whenever its snapshot has changed."""
+        makers = [self, *self.peers]
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        sent = {}
+        try:
+            while True:
+                # take the events before rendering, a snapshot published while rendering wakes the loop again
+                changed = [maker.stats_changed for maker in makers]
+                for maker in makers:
+                    # compared without the snapshot time, an unchanged card is not sent again
+                    content = json.dumps(maker.statistics, default=str)
+                    if sent.get(maker.network) != content:
+                        sent[maker.network] = content
+                        card = aiohttp_jinja2.render_string('network_statistics.html', request, {
+                            'network_name': maker.network,
+                            'statistics': maker.statistics,
+                            'updated': self._stats_time(maker),
+                        })
+                        data = json.dumps({'id': f"stats-{maker.network}", 'html': card})
+                        await response.write(f"event: stats\ndata: {data}\n\n".encode())
+                waiters = [asyncio.ensure_future(event.wait()) for event in changed]
+                done, pending = await asyncio.wait(waiters, timeout=settings.STATS_KEEPALIVE_INTERVAL,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for waiter in pending:
+                    waiter.cancel()
+                if not done:
+                    # a comment line, lets the server notice closed connections
+                    await response.write(b": keepalive\n\n")
+        except ConnectionResetError:
+            pass
+        return response
+
+    async def refresh_statistics_now(self, request):
+        """Checks the pending tickets and collects the statistics at most once per STATS_REFRESH_MIN_INTERVAL."""
+        wait = self.last_stats_refresh + settings.STATS_REFRESH_MIN_INTERVAL - time.time()
+        if wait > 0:
+            message = f"Refreshed recently, next refresh possible in {wait:.0f} secs"
+        else:
+            self.last_stats_refresh = time.time()
+            for maker in [self, *self.peers]:
+                if not maker.db.initialized:
+                    continue
+                try:
+                    if 'poller' in maker.roles and not maker.client.breaker.is_open:
+                        await maker.update_statuses()
+                    await maker.collect_stats()
+                except Exception as error:
+                    logging.exception(error)
+            message = "Refreshed"
+        refresh = '<div id="refresh-statistics" class="mb-6">' \
+                  '<button class="bg-blue-500 text-white rounded px-4 py-1" hx-post="/refresh_statistics" hx-target="#refresh-statistics" hx-swap="outerHTML">Refresh now</button>' \
+                  '<span class="ml-2">{message}</span></div>'.format(message=message)
+        return web.Response(text=refresh, content_type='text/html')
+
     @staticmethod
     async def toggle_create_images(request):
         settings.ENABLE_GENERATE_IMAGES = not settings.ENABLE_GENERATE_IMAGES
@@ -448,6 +1025,66 @@ class NetworkMaker:
         )
         return web.Response(text=checkbox, content_type='text/html')
 
+    @staticmethod
+    async def set_preset(request):
+        data = await request.post()
+        preset = data.get('preset')
+        if preset in SD_PRESETS:
+            settings.SD_PRESET = preset
+            logging.info(f"set_preset: image preset {preset} will be used from the next batch")
+        options = ''.join('<option value="{name}" {selected}>{name}</option>'.format(
+            name=name, selected='selected' if name == settings.SD_PRESET else '') for name in SD_PRESETS)
+        select = '<select class="form-select" id="select-preset" name="preset" hx-post="/set_preset" hx-trigger="change" hx-swap="outerHTML">{options}</select>'.format(
+            options=options
+        )
+        return web.Response(text=select, content_type='text/html')
+
+    @staticmethod
+    async def set_watermarks(request):
+        data = await request.post()
+        try:
+            low, high = int(data.get('low', '')), int(data.get('high', ''))
+        except ValueError:
+            low, high = settings.GENERATE_LOW_WATERMARK, settings.GENERATE_HIGH_WATERMARK
+        if 0 <= low <= high or (high == 0 and low >= 0):
+            settings.GENERATE_LOW_WATERMARK, settings.GENERATE_HIGH_WATERMARK = low, high
+            logging.info(f"set_watermarks: image backlog watermarks low {low}, high {high}")
+        form = '<form id="form-watermarks" class="flex items-center" hx-post="/set_watermarks" hx-trigger="change" hx-swap="outerHTML">' \
+               '<input type="number" class="form-input w-24" name="low" min="0" value="{low}">' \
+               '<input type="number" class="form-input w-24 ml-2" name="high" min="0" value="{high}">' \
+               '<span class="ml-2">Image backlog low/high watermarks (high 0 - off)</span></form>'.format(
+            low=settings.GENERATE_LOW_WATERMARK, high=settings.GENERATE_HIGH_WATERMARK
+        )
+        return web.Response(text=form, content_type='text/html')
+
+
+def create_makers(networks: list, api_keys: list, gateway_url: str = None, roles=None) -> list:
+    """
+    One NetworkMaker per network, each with its own gateway client, ticket tables and ticket/poll loops. The first
+    one generates images and serves the dashboard for all of them; the others share its models and take their
+    images from the same `images` table. All of them use one connection pool, so the process has a single writer.
+    """
+    roles = set(roles or ROLES)
+    pool = ConnectionPool(settings.DB_NAME, settings.DB_READ_CONNECTIONS)
+    first = NetworkMaker(networks[0], api_keys[0], gateway_url, roles=roles, db_pool=pool)
+    peers = [NetworkMaker(network, api_key, gateway_url,
+                          img_generator=first.img_generator, prompt_generator=first.prompt_generator,
+                          roles=roles - {'generator', 'dashboard'}, db_pool=pool, phash_index=first.phash_index)
+             for network, api_key in zip(networks[1:], api_keys[1:])]
+    first.peers = peers
+    return [first, *peers]
+
+
+async def run_makers(makers: list):
+    try:
+        # wait for every maker to stop, even when one fails or all are cancelled, before the shared pool is closed
+        results = await asyncio.gather(*[maker.run() for maker in makers], return_exceptions=True)
+        for maker, result in zip(makers, results):
+            if isinstance(result, Exception):
+                logging.error(f"{maker.network}: stopped with an error", exc_info=result)
+    finally:
+        await makers[0].db.pool.close()
+
 
 async def shutdown_tasks_and_cleanup(loop):
     tasks = [t for t in asyncio.all_tasks(loop) if t is not
@@ -466,24 +1103,42 @@ def graceful_shutdown(signal, loop):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Pastel Network Maker')
-    parser.add_argument('-n', '--network', type=str, required=True, help='Network to use - mainnet, testnet or devnet')
-    parser.add_argument('-k', '--api-key', type=str, required=True, help='API Key to use')
+    parser.add_argument('-n', '--network', type=str, required=True, action='append',
+                        help='Network to use - mainnet, testnet or devnet, repeat with -k for several networks')
+    parser.add_argument('-k', '--api-key', type=str, required=True, action='append',
+                        help='API Key to use, one per -n in the same order')
     parser.add_argument('-l', '--logfile', type=str, required=False, help='Log file')
+    parser.add_argument('-g', '--gateway-url', type=str, required=False,
+                        help='Custom gateway URL, e.g. a local mock_gateway.py')
+    parser.add_argument('-r', '--role', type=str, default='all',
+                        help=f"Comma separated roles of this node - {', '.join(ROLES)} or all")
+    parser.add_argument('-p', '--port', type=int, required=False, help='Dashboard port')
     args = parser.parse_args()
 
-    if args.network not in ["mainnet", "testnet", "devnet"]:
+    if any(network not in ["mainnet", "testnet", "devnet"] for network in args.network):
         raise ValueError("Invalid network")
+    if len(set(args.network)) != len(args.network):
+        raise ValueError("Every network can be given only once")
+    if len(args.api_key) != len(args.network):
+        raise ValueError("Give one API key per network")
+    roles = set(ROLES) if args.role == 'all' else {role.strip() for role in args.role.split(',')}
+    if not roles or not roles.issubset(ROLES):
+        raise ValueError("Invalid role")
+    if args.port:
+        settings.WEB_PORT = args.port
 
     setup_logging(args.logfile)
 
-    maker = NetworkMaker(args.network, args.api_key)
+    makers = create_makers(args.network, args.api_key, args.gateway_url, roles=roles)
+    # module imports are CPU bound, the CPU time used so far is a good estimate of their cost
+    makers[0].startup = {'imports (CPU)': time.process_time(), **makers[0].startup}
     loop = asyncio.get_event_loop()
     signals = (signal.SIGTERM, signal.SIGINT)
     for s in signals:
         loop.add_signal_handler(s, lambda sig=s: graceful_shutdown(sig, loop))
 
     try:
-        loop.create_task(maker.run())
+        loop.create_task(run_makers(makers))
         loop.run_forever()
     except asyncio.CancelledError:
         pass
@@ -0,0 +1,135 @@
+"""
+Local stand-in for the Pastel gateway endpoints used by NetworkMaker.
+
+Implements the Cascade, Sense and NFT process-request and get-result endpoints with configurable latency,
+error rate and status-transition timing, so GatewayApiClientAsync can be pointed at it with `custom_url`:
+
+    python mock_gateway.py --port 8090 --latency 0.05 --error-rate 0.01 --step 5
+    python main.py -n testnet -k test --gateway-url http://127.0.0.1:8090
+"""
+from aiohttp import web
+
+import argparse
+import asyncio
+import random
+import time
+import uuid
+
+
+# the order in which a registration goes through the gateway statuses
+STATUS_FLOW = [
+    "PENDING",
+    "RESULT COMPLETE. PENDING REGISTRATION",
+    "REGISTRATION COMPLETE. PENDING ACTIVATION",
+    "SUCCESS",
+]
+
+
+class MockGateway:
+    """
+    Attributes:
+        latency (float): mean response delay in seconds, the actual delay is uniform in [0, 2 * latency].
+        error_rate (float): share of requests answered with HTTP 500.
+        step (float): seconds a result spends in every status of STATUS_FLOW.
+        failure_rate (float): share of results that end up FAILED instead of SUCCESS.
+    """
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0, step: float = 5.0, failure_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.step = step
+        self.failure_rate = failure_rate
+        self.results = {}
+        self.requests = {}
+        self.stats = {'process_request': 0, 'get_result': 0, 'errors': 0}
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        for ticket_type in ('cascade', 'sense', 'nft'):
+            app.add_routes([
+                web.post(f'/api/v1/{ticket_type}', self.process_request),
+                web.get(f'/api/v1/{ticket_type}/gateway_results/{{result_id}}', self.get_result),
+            ])
+        app.add_routes([web.get('/mock/stats', self.get_stats)])
+        return app
+
+    async def _delay_or_fail(self):
+        if self.latency > 0:
+            await asyncio.sleep(random.uniform(0, 2 * self.latency))
+        if random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            raise web.HTTPInternalServerError(text='{"detail": "mock gateway error"}', content_type='application/json')
+
+    def _result(self, result_id: str) -> dict:
+        result = self.results[result_id]
+        step = int((time.time() - result['created']) / self.step) if self.step > 0 else len(STATUS_FLOW)
+        status = STATUS_FLOW[min(step, len(STATUS_FLOW) - 1)]
+        if status == "SUCCESS" and result['fails']:
+            status = "FAILED"
+        data = {
+            'result_id': result_id,
+            'result_status': status,
+            'file_name': result['file_name'],
+            'file_type': 'image/jpeg',
+        }
+        if status in ("REGISTRATION COMPLETE. PENDING ACTIVATION", "SUCCESS"):
+            data['registration_ticket_txid'] = f"reg-{result_id}"
+        if status == "SUCCESS":
+            data['activation_ticket_txid'] = f"act-{result_id}"
+        return data
+
+    async def process_request(self, request: web.Request) -> web.Response:
+        self.stats['process_request'] += 1
+        await self._delay_or_fail()
+        file_names = []
+        reader = await request.multipart()
+        async for part in reader:
+            if part.filename:
+                file_names.append(part.filename)
+            await part.read(decode=False)
+        request_id = str(uuid.uuid4())
+        result_ids = []
+        for file_name in file_names:
+            result_id = str(uuid.uuid4())
+            self.results[result_id] = {
+                'created': time.time(),
+                'file_name': file_name,
+                'fails': random.random() < self.failure_rate,
+            }
+            result_ids.append(result_id)
+        self.requests[request_id] = result_ids
+        return web.json_response({
+            'request_id': request_id,
+            'request_status': 'PENDING',
+            'results': [self._result(result_id) for result_id in result_ids],
+        })
+
+    async def get_result(self, request: web.Request) -> web.Response:
+        self.stats['get_result'] += 1
+        await self._delay_or_fail()
+        result_id = request.match_info['result_id']
+        if result_id not in self.results:
+            raise web.HTTPNotFound(text='{"detail": "result not found"}', content_type='application/json')
+        return web.json_response(self._result(result_id))
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, 'results': len(self.results)})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8090) -> web.AppRunner:
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Mock Pastel Gateway')
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean response delay, secs')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing with HTTP 500')
+    parser.add_argument('--step', type=float, default=5.0, help='Secs a result spends in every status')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of results ending up FAILED')
+    args = parser.parse_args()
+
+    gateway = MockGateway(args.latency, args.error_rate, args.step, args.failure_rate)
+    web.run_app(gateway.app(), host=args.host, port=args.port)
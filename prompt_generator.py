@@ -1,38 +1,267 @@
 import json
+import logging
+import os
+import pickle
+import time
 
 from llama_cpp import Llama, LlamaGrammar
 
 from config import settings
 
 
+class JsonStreamGuard:
+    """
+    Follows a streamed JSON completion character by character, without parsing it, to tell when the top level
+    object or array is complete and to abort as soon as the output is obviously wrong: it does not start with
+    `{` or `[`, closes more brackets than it opened or has a string longer than `max_field_chars`.
+    """
+    def __init__(self, max_field_chars: int):
+        self.max_field_chars = max_field_chars
+        self.length = 0
+        self.depth = 0
+        self.root = None
+        self.in_string = False
+        self.escape = False
+        self.string_length = 0
+        self.complete = False
+        self.error = None
+        # end of the last complete element of a top level array, what can be salvaged from an aborted batch
+        self.last_item_end = 0
+
+    def feed(self, text: str) -> bool:
+        """Returns False when the completion should stop, check `complete` and `error` for the reason."""
+        for char in text:
+            self.length += 1
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    continue
+                self.string_length += 1
+                if 0 < self.max_field_chars < self.string_length:
+                    self.error = f"field longer than {self.max_field_chars} chars"
+                    return False
+                continue
+            if char.isspace():
+                continue
+            if self.root is None:
+                if char not in '{[':
+                    self.error = f"unexpected {char!r} at the start"
+                    return False
+                self.root = char
+            if char == '"':
+                self.in_string = True
+                self.string_length = 0
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth < 0:
+                    self.error = f"unbalanced {char!r}"
+                    return False
+                if self.depth == 1:
+                    self.last_item_end = self.length
+                if self.depth == 0:
+                    self.complete = True
+                    return False
+        return True
+
+
 class LlamaPromptGenerator:
     def __init__(self):
         if settings.USE_GPU:
             self.llm = Llama(model_path=settings.PROMPT_MODEL_PATH,
-                             chat_format=settings.PROMPT_CHAT_FORMAT, n_gpu_layers=-1, n_ctx=2048)
+                             chat_format=settings.PROMPT_CHAT_FORMAT, n_gpu_layers=-1,
+                             n_ctx=settings.PROMPT_CONTEXT_SIZE)
         else:
             self.llm = Llama(model_path=settings.PROMPT_MODEL_PATH,
-                             chat_format=settings.PROMPT_CHAT_FORMAT)
+                             chat_format=settings.PROMPT_CHAT_FORMAT, n_ctx=settings.PROMPT_CONTEXT_SIZE)
         self.system_message = {"role": "system", "content": settings.LLAMA_SYSTEM_PROMPT}
 
         self.grammar = None
         with open(settings.GRAMMAR_PATH, "r") as file:
             grammar_text = file.read()
             self.grammar = LlamaGrammar.from_string(grammar_text)
+        self.batch_grammar = None
+        with open(settings.BATCH_GRAMMAR_PATH, "r") as file:
+            self.batch_grammar = LlamaGrammar.from_string(file.read())
+
+        # tokens every completion starts with (chat template + system prompt) and the model state after them
+        self.prefix_tokens = None
+        self.prefix_state = None
+        self.timings = {'calls': 0, 'aborted': 0, 'kv_reuse': 0, 'restores': 0, 'snapshots': 0, 'prefill_secs': 0.0, 'decode_secs': 0.0}
+        if settings.PROMPT_PREFIX_CACHE:
+            self._load_prefix_state()
 
     def generate_prompt(self, tip: str = "") -> dict:
         user_prompt = settings.LLAMA_USER_REQUEST.format(tip)
-        output = self.llm.create_chat_completion(
-            grammar=self.grammar,
-            messages=[
-                self.system_message,
-                {"role": "user", "content": user_prompt}
-            ]
-        )
-        return self.parse_output(output)
+        content = self._complete(self.grammar, [
+            self.system_message,
+            {"role": "user", "content": user_prompt}
+        ], settings.PROMPT_MAX_TOKENS)
+        return self.parse_content(content)
+
+    def generate_prompts(self, tip: str = "", count: int = 1) -> list:
+        """
+        Asks for `count` descriptions in one completion, constrained to a JSON array of ImageSpec objects,
+        so the system prompt is evaluated once per batch instead of once per image.
+        The model may return fewer or more descriptions than asked for.
+        """
+        user_prompt = settings.LLAMA_BATCH_USER_REQUEST.format(count, tip)
+        content = self._complete(self.batch_grammar, [
+            self.system_message,
+            {"role": "user", "content": user_prompt}
+        ], settings.PROMPT_MAX_TOKENS * count)
+        try:
+            prompts = self.parse_content(content)
+        except json.JSONDecodeError:
+            # the completion ran out of tokens in the middle of the array
+            return []
+        return prompts if isinstance(prompts, list) else []
+
+    def _complete(self, grammar, messages: list, max_tokens: int) -> str:
+        """
+        Streams one chat completion. Time to the first token is the prompt prefill, the rest is decoding.
+
+        Generation stops as soon as the JSON is complete and is aborted on invalid output, a field over
+        PROMPT_MAX_FIELD_CHARS chars or `max_tokens` tokens. An aborted completion returns "", or the complete
+        elements of an aborted array.
+        """
+        if settings.PROMPT_PREFIX_CACHE:
+            self._restore_prefix()
+        guard = JsonStreamGuard(settings.PROMPT_MAX_FIELD_CHARS)
+        start = time.perf_counter()
+        first_token = None
+        content = []
+        stream = self.llm.create_chat_completion(grammar=grammar, messages=messages, stream=True,
+                                                 max_tokens=max_tokens if max_tokens > 0 else None)
+        try:
+            for chunk in stream:
+                delta = chunk['choices'][0].get('delta', {})
+                if delta.get('content'):
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    content.append(delta['content'])
+                    if not guard.feed(delta['content']):
+                        break
+        finally:
+            stream.close()
+        end = time.perf_counter()
+        text = ''.join(content)[:guard.length]
+        if not guard.complete:
+            self.timings['aborted'] += 1
+            logging.info(f"LlamaPromptGenerator: completion aborted - {guard.error or 'token budget exhausted'}")
+            text = text[:guard.last_item_end] + ']' if guard.root == '[' and guard.last_item_end else ""
+        first_token = first_token or end
+        self.timings['calls'] += 1
+        self.timings['prefill_secs'] += first_token - start
+        self.timings['decode_secs'] += end - first_token
+        if settings.PROMPT_PREFIX_CACHE:
+            self._update_prefix()
+        return text
+
+    def _evaluated_tokens(self) -> list:
+        return [int(token) for token in self.llm.input_ids[:self.llm.n_tokens]]
+
+    def _restore_prefix(self):
+        """
+        llama.cpp re-evaluates only the part of a prompt that differs from the tokens already in its KV cache.
+        The previous completion normally leaves the prefix there; when it does not - after a restart or a
+        completion with a different system prompt - the snapshot is loaded instead of evaluating the prefix again.
+        """
+        if self.prefix_state is None:
+            return
+        if self._evaluated_tokens()[:len(self.prefix_tokens)] == self.prefix_tokens:
+            # llama.cpp's own KV cache reuse, the snapshot is not needed
+            self.timings['kv_reuse'] += 1
+        else:
+            self.llm.load_state(self.prefix_state)
+            self.timings['restores'] += 1
+
+    def _update_prefix(self):
+        """
+        The shared prefix is the longest common prefix of the tokens of all completions so far, it only shrinks,
+        so it settles on the chat template and system prompt once two completions for different genres are done.
+        """
+        tokens = self._evaluated_tokens()
+        if self.prefix_tokens is None:
+            self.prefix_tokens = tokens
+            return
+        common = 0
+        for a, b in zip(self.prefix_tokens, tokens):
+            if a != b:
+                break
+            common += 1
+        if self.prefix_state is not None and common == len(self.prefix_tokens):
+            return
+        self.prefix_tokens = self.prefix_tokens[:common]
+        if not self.prefix_tokens:
+            return
+        self.llm.reset()
+        self.llm.eval(self.prefix_tokens)
+        self.prefix_state = self.llm.save_state()
+        self.timings['snapshots'] += 1
+        logging.info(f"LlamaPromptGenerator: cached state of a {len(self.prefix_tokens)} tokens prompt prefix")
+        self._save_prefix_state()
+
+    def _cache_key(self) -> dict:
+        return {
+            'model': settings.PROMPT_MODEL_PATH,
+            'chat_format': settings.PROMPT_CHAT_FORMAT,
+            'n_ctx': settings.PROMPT_CONTEXT_SIZE,
+            'system_prompt': settings.LLAMA_SYSTEM_PROMPT,
+        }
+
+    def _save_prefix_state(self):
+        if not settings.PROMPT_PREFIX_CACHE_PATH:
+            return
+        try:
+            with open(settings.PROMPT_PREFIX_CACHE_PATH, "wb") as file:
+                pickle.dump({'key': self._cache_key(), 'tokens': self.prefix_tokens, 'state': self.prefix_state},
+                            file)
+        except Exception as error:
+            logging.error(f"LlamaPromptGenerator: cannot save prompt prefix state - {error}")
+
+    def _load_prefix_state(self):
+        if not settings.PROMPT_PREFIX_CACHE_PATH or not os.path.exists(settings.PROMPT_PREFIX_CACHE_PATH):
+            return
+        try:
+            with open(settings.PROMPT_PREFIX_CACHE_PATH, "rb") as file:
+                cached = pickle.load(file)
+        except Exception as error:
+            logging.error(f"LlamaPromptGenerator: cannot load prompt prefix state - {error}")
+            return
+        if cached.get('key') != self._cache_key():
+            logging.info("LlamaPromptGenerator: prompt prefix state is for another model or system prompt")
+            return
+        self.prefix_tokens = cached['tokens']
+        self.prefix_state = cached['state']
+        logging.info(f"LlamaPromptGenerator: loaded state of a {len(self.prefix_tokens)} tokens prompt prefix")
+
+    def stats(self) -> dict:
+        calls = self.timings['calls']
+        if not calls:
+            return {}
+        return {
+            'completions': calls,
+            'aborted': self.timings['aborted'],
+            'prefix tokens': len(self.prefix_tokens or []),
+            'prefix kept in KV cache': f"{100 * self.timings['kv_reuse'] / calls:.0f}%",
+            'prefix restored from snapshot': self.timings['restores'],
+            'prefix snapshots': self.timings['snapshots'],
+            'prefill secs/completion': f"{self.timings['prefill_secs'] / calls:.2f}",
+            'decode secs/completion': f"{self.timings['decode_secs'] / calls:.2f}",
+        }
+
+    @staticmethod
+    def parse_content(content: str) -> dict|list|None:
+        return json.loads(content) if content else None
 
     @staticmethod
-    def parse_output(output) -> dict|None:
+    def parse_output(output) -> dict|list|None:
         if (output and
                 'choices' in output and output['choices'] and len(output['choices']) > 0 and
                 'message' in output['choices'][0] and output['choices'][0]['message'] and
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import sqlite3
+
+import db_migrations
+from db_manager import ConnectionPool, SQLiteDB
+
+NETWORKS = ('testnet', 'devnet')
+
+
+def create_baseline_db(db_path):
+    """Creates the schema the first release wrote for every network, before schema versions existed."""
+    with sqlite3.connect(db_path) as db:
+        for network in NETWORKS:
+            db.execute(f'''
+                CREATE TABLE collections_{network} (
+                    id INTEGER PRIMARY KEY,
+                    collection_type TEXT,
+                    name TEXT,
+                    max_collection_entries INTEGER,
+                    collection_item_copy_count INTEGER,
+                    list_of_pastelids_of_authorized_contributors TEXT,
+                    max_permitted_open_nsfw_score REAL,
+                    minimum_similarity_score_to_first_entry_in_collection REAL,
+                    no_of_days_to_finalize_collection INTEGER,
+                    royalty REAL,
+                    green BOOLEAN,
+                    status TEXT,
+                    req_id TEXT,
+                    res_id TEXT,
+                    reg_txid TEXT,
+                    act_txid TEXT
+                )
+            ''')
+            db.execute(f'''
+                CREATE TABLE cascade_{network} (
+                    id INTEGER PRIMARY KEY,
+                    make_publicly_accessible BOOLEAN,
+                    status TEXT,
+                    req_id TEXT,
+                    res_id TEXT,
+                    reg_txid TEXT,
+                    act_txid TEXT
+                )
+            ''')
+            db.execute(f'''
+                CREATE TABLE sense_{network} (
+                    id INTEGER PRIMARY KEY,
+                    collection_act_txid TEXT,
+                    open_api_group_id TEXT,
+                    status TEXT,
+                    req_id TEXT,
+                    res_id TEXT,
+                    reg_txid TEXT,
+                    act_txid TEXT,
+                    FOREIGN KEY(collection_act_txid) REFERENCES collections_{network}(act_txid)
+                )
+            ''')
+            db.execute(f'''
+                CREATE TABLE nft_{network} (
+                    id INTEGER PRIMARY KEY,
+                    issued_copies INTEGER,
+                    royalty REAL,
+                    green BOOLEAN,
+                    collection_act_txid TEXT,
+                    open_api_group_id TEXT,
+                    make_publicly_accessible BOOLEAN,
+                    status TEXT,
+                    req_id TEXT,
+                    res_id TEXT,
+                    reg_txid TEXT,
+                    act_txid TEXT,
+                    FOREIGN KEY(collection_act_txid) REFERENCES collections_{network}(act_txid)
+                )
+            ''')
+        db.execute('''
+            CREATE TABLE images (
+                id INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                name TEXT,
+                creator_name TEXT,
+                keywords TEXT,
+                series_name TEXT,
+                file_path TEXT,
+                cascade_id INTEGER,
+                sense_id INTEGER,
+                nft_id INTEGER
+            )
+        ''')
+        db.executemany("INSERT INTO images (description, name, file_path) VALUES (?, ?, ?)",
+                       [(f"image {i}", f"name {i}", f"/images/{i}.png") for i in range(1, 21)])
+        # images 1-4 were registered on testnet, 5-6 on devnet, one ticket of each is still pending
+        db.executemany("INSERT INTO cascade_testnet (make_publicly_accessible, status) VALUES (1, ?)",
+                       [('SUCCESS', ), ('SUCCESS', ), ('PENDING', ), (None, )])
+        db.execute("UPDATE images SET cascade_id = id WHERE id <= 4")
+        db.executemany("INSERT INTO sense_devnet (status) VALUES (?)", [('SUCCESS', ), ('PENDING', )])
+        db.execute("UPDATE images SET sense_id = id - 4 WHERE id IN (5, 6)")
+
+
+def count_rows(db_path, network) -> dict:
+    """The non-zero counters of `network` as SQLiteDB.read_counters() should report them, counted from the tables."""
+    with sqlite3.connect(db_path) as db:
+        counts = {'images': {
+            'total': db.execute("SELECT COUNT(*) FROM images").fetchone()[0],
+            'for_cascade': db.execute("SELECT COUNT(*) FROM images WHERE cascade_id IS NULL").fetchone()[0],
+            'for_sense_or_nft': db.execute("SELECT COUNT(*) FROM images WHERE sense_id IS NULL AND nft_id IS NULL "
+                                           "AND near_duplicate_of IS NULL").fetchone()[0],
+        }}
+        for table_name in (f'cascade_{network}', f'sense_{network}', f'nft_{network}', f'collections_{network}'):
+            counts[table_name] = {status or '': count for status, count
+                                  in db.execute(f"SELECT status, COUNT(*) FROM {table_name} GROUP BY status")}
+    return {table_name: {key: value for key, value in table_counts.items() if value}
+            for table_name, table_counts in counts.items()}
+
+
+async def read_counters(db: SQLiteDB) -> dict:
+    # a counter that dropped to zero keeps its row
+    return {table_name: {key: value for key, value in counters.items() if value}
+            for table_name, counters in (await db.read_counters()).items()}
+
+
+async def open_networks(db_path) -> tuple[ConnectionPool, list[SQLiteDB]]:
+    pool = ConnectionPool(db_path)
+    dbs = [SQLiteDB(db_path, network, pool) for network in NETWORKS]
+    for db in dbs:
+        await db.initialize_db()
+    return pool, dbs
+
+
+def test_baseline_db_is_migrated_for_both_networks(tmp_path):
+    db_path = str(tmp_path / 'images.sqlite')
+    create_baseline_db(db_path)
+
+    async def run():
+        pool, dbs = await open_networks(db_path)
+        try:
+            for db in dbs:
+                assert await db.schema_version() == db_migrations.LATEST_VERSION
+                assert await read_counters(db) == count_rows(db_path, db.network_name)
+            testnet = dbs[0]
+            assert (await testnet.number_of_images())[0] == 20
+            assert (await testnet.number_of_images_for_cascade())[0] == 16
+            assert dict(await testnet.get_cascade_counts()) == {'SUCCESS': 2, 'PENDING': 1, None: 1}
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+    # the migrations kept the rows written before them
+    with sqlite3.connect(db_path) as db:
+        assert db.execute("SELECT cascade_id, sense_id FROM images WHERE id IN (3, 6) ORDER BY id").fetchall() == \
+               [(3, None), (None, 2)]
+        assert db.execute("SELECT namespace, version FROM schema_version ORDER BY namespace").fetchall() == \
+               [(network, db_migrations.LATEST_VERSION) for network in sorted(NETWORKS)]
+
+
+def test_counters_follow_writes(tmp_path):
+    db_path = str(tmp_path / 'images.sqlite')
+    create_baseline_db(db_path)
+
+    async def run():
+        pool, (testnet, devnet) = await open_networks(db_path)
+        try:
+            for i in range(21, 31):
+                await testnet.add_image(f"image {i}", f"name {i}", f"/images/{i}.png")
+
+            claimed = await testnet.claim_images_for_cascade('worker-1', limit=3)
+            await testnet.add_cascade_batch([(img['id'], 'PENDING', f"req {img['id']}", '', '', '')
+                                             for img in claimed], worker_id='worker-1')
+            claimed = await devnet.claim_images_for_cascade('worker-2', limit=2)
+            await devnet.add_cascade_batch([(img['id'], 'PENDING', f"req {img['id']}", '', '', '')
+                                            for img in claimed], worker_id='worker-2')
+
+            claimed = await testnet.claim_images_for_sense_or_nft('worker-1', limit=4)
+            await testnet.add_sense_batch([(img['id'], 'PENDING', f"req {img['id']}", '', '', '')
+                                           for img in claimed[:2]], worker_id='worker-1')
+            await testnet.add_nft(claimed[2]['id'], 'PENDING', 'req nft', '', '', '',
+                                  issued_copies=1, royalty=0.0, green=False, worker_id='worker-1')
+            await testnet.release_sense_or_nft_claim([claimed[3]['id']], 'worker-1')
+
+            # a claimed image and an unclaimed one turn out to be near-duplicates of a submitted image
+            claimed = await devnet.claim_images_for_sense_or_nft('worker-2', limit=1)
+            await devnet.mark_near_duplicates([(claimed[0]['id'], 5), (30, 5)])
+
+            await testnet.update_cascade_status(3, 'SUCCESS', 'reg', 'act')
+            await testnet.update_cascade_status(4, 'FAILED', '', '')
+            await testnet.update_cascade_statuses([(5, 'SUCCESS', 'reg', 'act', 0), (6, 'PENDING', '', '', 1)])
+            await devnet.update_sense_status(2, 'SUCCESS', 'reg', 'act')
+
+            for db in (testnet, devnet):
+                assert await read_counters(db) == count_rows(db_path, db.network_name)
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+
+def test_lost_claim_does_not_link_image(tmp_path, caplog):
+    db_path = str(tmp_path / 'images.sqlite')
+
+    async def run():
+        db = SQLiteDB(db_path, 'testnet')
+        await db.initialize_db()
+        try:
+            await db.add_image("image", "name", "/images/1.png")
+            first = await db.claim_images_for_cascade('worker-1', lease=0)
+            # the lease of worker-1 ran out, worker-2 claims the same image
+            await asyncio.sleep(0.01)
+            second = await db.claim_images_for_cascade('worker-2')
+            assert first[0]['id'] == second[0]['id']
+
+            with caplog.at_level(logging.WARNING):
+                await db.add_cascade_batch([(first[0]['id'], 'PENDING', 'req 1', '', '', '')], worker_id='worker-1')
+            assert "claim of image 1 by worker-1 was lost" in caplog.text
+            image = (await db.read_all_images())[0]
+            assert image['cascade_id'] is None
+            assert image['cascade_claimed_by'] == 'worker-2'
+
+            await db.add_cascade_batch([(second[0]['id'], 'PENDING', 'req 2', '', '', '')], worker_id='worker-2')
+            image = (await db.read_all_images())[0]
+            assert image['cascade_id'] == 2
+            assert image['cascade_claimed_by'] is None
+            assert await read_counters(db) == count_rows(db_path, 'testnet')
+        finally:
+            await db.close()
+
+    asyncio.run(run())
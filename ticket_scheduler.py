@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+import random
+import time
+
+
+class TicketPlan:
+    """
+    Load plan of one ticket type.
+
+    Attributes:
+        key: ticket type the scheduler hands out.
+        name (str): name shown in the statistics.
+        enabled (callable): returns whether the type is enabled right now.
+        target_per_hour (callable): returns the target submission rate.
+        max_in_flight (callable): returns the maximum number of tickets not yet in a terminal state.
+        in_flight (async callable): returns the number of tickets not yet in a terminal state.
+        backlog (async callable): returns the number of images still available for the type.
+    """
+    def __init__(self, key, name: str, enabled, target_per_hour, max_in_flight, in_flight, backlog):
+        self.key = key
+        self.name = name
+        self.enabled = enabled
+        self.target_per_hour = target_per_hour
+        self.max_in_flight = max_in_flight
+        self.in_flight = in_flight
+        self.backlog = backlog
+        self.credit = 0.0
+        self.submitting = 0
+        self.submitted = deque()
+        self.blocked_by = ""
+
+
+class TicketScheduler:
+    """
+    Paces ticket submissions to a target rate per type.
+
+    Every enabled type earns credit at target_per_hour / 3600 per second, capped at `max_burst`, so a type that
+    could not submit for a while may catch up a little but never floods the network. A type is due when it has a
+    full credit, fewer than max_in_flight tickets pending and images left in its backlog. Among due types the
+    next one is drawn with weights proportional to their credit, i.e. to how far they are behind target.
+    """
+    def __init__(self, plans: list, max_burst: float = 3.0, idle_wait: float = 30.0):
+        self.plans = plans
+        self.max_burst = max(1.0, max_burst)
+        self.idle_wait = idle_wait
+        self._updated = time.monotonic()
+        # the checks await DB reads, concurrent workers must not all pass them before one reserves the slot
+        self._lock = asyncio.Lock()
+
+    def _accrue(self):
+        now = time.monotonic()
+        elapsed, self._updated = now - self._updated, now
+        for plan in self.plans:
+            if plan.enabled() and plan.target_per_hour() > 0:
+                plan.credit = min(self.max_burst, plan.credit + elapsed * plan.target_per_hour() / 3600)
+
+    async def next_ticket(self):
+        """
+        Returns (ticket type, 0) when a type is due - its slot is reserved until `done` is called -
+        or (None, seconds to wait) when nothing is due yet.
+        """
+        async with self._lock:
+            return await self._select()
+
+    async def _select(self):
+        self._accrue()
+        wait = self.idle_wait
+        candidates = []
+        for plan in self.plans:
+            plan.blocked_by = ""
+            target = plan.target_per_hour()
+            if not plan.enabled() or target <= 0:
+                plan.blocked_by = "disabled"
+                continue
+            if plan.credit < 1:
+                plan.blocked_by = "pacing"
+                wait = min(wait, (1 - plan.credit) * 3600 / target)
+                continue
+            if await plan.in_flight() + plan.submitting >= plan.max_in_flight():
+                plan.blocked_by = "max in flight"
+                continue
+            if await plan.backlog() <= plan.submitting:
+                plan.blocked_by = "no images"
+                continue
+            candidates.append(plan)
+
+        if not candidates:
+            return None, max(0.1, wait)
+        plan = random.choices(candidates, weights=[plan.credit for plan in candidates])[0]
+        plan.credit -= 1
+        plan.submitting += 1
+        return plan.key, 0
+
+    def done(self, key, count: int):
+        """Releases the slot reserved by next_ticket, `count` is the number of images actually submitted."""
+        for plan in self.plans:
+            if plan.key != key:
+                continue
+            plan.submitting = max(0, plan.submitting - 1)
+            if count == 0:
+                # nothing was submitted, the slot's credit is refunded
+                plan.credit = min(self.max_burst, plan.credit + 1)
+            else:
+                # the slot already paid for one ticket, batches pay for the rest
+                plan.credit -= count - 1
+            now = time.time()
+            plan.submitted.extend([now] * count)
+            while plan.submitted and plan.submitted[0] < now - 3600:
+                plan.submitted.popleft()
+
+    def stats(self) -> dict:
+        stats = {}
+        now = time.time()
+        for plan in self.plans:
+            last_hour = sum(1 for t in plan.submitted if t >= now - 3600)
+            stats[plan.name] = (
+                f"target {plan.target_per_hour():g}/h, last hour {last_hour}, "
+                f"credit {plan.credit:.2f}{', ' + plan.blocked_by if plan.blocked_by else ''}")
+        return stats